@@ -33,6 +33,8 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     download = presence_analyzer.script:download_users
+    import-sqlite = presence_analyzer.script:import_sqlite
+    benchmark = presence_analyzer.benchmarks:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
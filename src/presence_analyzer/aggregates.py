@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed aggregates of presence data by weekday.
+"""
+import sys
+import copy
+import time
+from datetime import date
+from itertools import chain, izip
+
+from presence_analyzer.store import weekday
+
+# occupancy buckets of a day
+BUCKET_SECONDS = 15 * 60
+BUCKETS = 24 * 3600 // BUCKET_SECONDS
+
+
+class WeekdaySummary(object):
+    """
+    Index of precomputed weekday aggregates of every user.
+
+    For each user it keeps lists, indexed by weekday, of total presence
+    seconds ('total'), mean presence ('mean'), mean start ('start') and
+    mean end ('end'). Entry counts and sums of starts and ends are kept
+    too ('count', 'start_total', 'end_total'), so new entries can be
+    folded in without a rebuild. Build time (in seconds) and approximate
+    size (in bytes) are available as `build_time` and `nbytes` attributes.
+
+    Optional `first` and `last` day ordinals limit summary to entries
+    of a date range, bounds are inclusive.
+    """
+    KEYS = ('count', 'total', 'mean', 'start_total', 'start', 'end_total',
+            'end')
+
+    def __init__(self, store, first=None, last=None):
+        started = time.time()
+        self.first = first
+        self.last = last
+        self.users = {
+            user_id: self.summarize_user(store[user_id].between(first, last))
+            for user_id in store
+        }
+        self.build_time = time.time() - started
+        self.nbytes = self.measure()
+
+    @classmethod
+    def summarize_user(cls, user):
+        """
+        Builds summary of one user, see UserPresence.
+        """
+        summary = {key: [0] * 7 for key in cls.KEYS}
+        for day, start, end in user.weekday_entries():
+            cls.add_entry(summary, day, (start, end), 1)
+        cls.update_means(summary)
+        return summary
+
+    def apply(self, changes):
+        """
+        Folds (user_id, ordinal, old, new) changes from PresenceStore.extended.
+
+        Summaries of changed users are rebuilt from running sums and
+        swapped in at once, readers never see half-updated summary.
+        """
+        updated = {}
+        for user_id, ordinal, old, new in changes:
+            summary = updated.get(user_id)
+            if summary is None:
+                summary = updated[user_id] = self.copy_user(user_id)
+            if not self.covers(ordinal):
+                continue
+            day = weekday(ordinal)
+            if old is not None:
+                self.add_entry(summary, day, old, -1)
+            self.add_entry(summary, day, new, 1)
+
+        for summary in updated.itervalues():
+            self.update_means(summary)
+        self.users.update(updated)
+        self.nbytes = self.measure()
+
+    def copy(self):
+        """
+        Returns copy of the index, to which changes can be applied.
+
+        Summaries of users are shared, apply() replaces them instead of
+        modifying, so the original index stays unchanged.
+        """
+        summary = copy.copy(self)
+        summary.users = dict(self.users)
+        return summary
+
+    def covers(self, ordinal):
+        """
+        Checks whether date range of summary includes given day.
+        """
+        return ((self.first is None or self.first <= ordinal) and
+                (self.last is None or ordinal <= self.last))
+
+    def copy_user(self, user_id):
+        """
+        Returns copy of user summary, empty one for unknown users.
+        """
+        summary = self.users.get(user_id)
+        if summary is None:
+            return {key: [0] * 7 for key in self.KEYS}
+        return {key: list(values) for key, values in summary.iteritems()}
+
+    @classmethod
+    def from_sums(cls, sums):
+        """
+        Builds user summary from (weekday, count, total, start_total,
+        end_total) tuples, weekdays without entries may be left out.
+        """
+        summary = {key: [0] * 7 for key in cls.KEYS}
+        for day, count, total, start_total, end_total in sums:
+            summary['count'][day] = count
+            summary['total'][day] = total
+            summary['start_total'][day] = start_total
+            summary['end_total'][day] = end_total
+        cls.update_means(summary)
+        return summary
+
+    @staticmethod
+    def update_means(summary):
+        """
+        Recalculates means of user summary from its running sums.
+        """
+        for day, count in enumerate(summary['count']):
+            for total, mean in (('total', 'mean'),
+                                ('start_total', 'start'),
+                                ('end_total', 'end')):
+                summary[mean][day] = (
+                    float(summary[total][day]) / count if count > 0 else 0
+                )
+
+    @staticmethod
+    def add_entry(summary, day, entry, sign):
+        """
+        Adds (start, end) entry to running sums, removes it for sign -1.
+        """
+        start, end = entry
+        summary['count'][day] += sign
+        summary['total'][day] += sign * (end - start)
+        summary['start_total'][day] += sign * start
+        summary['end_total'][day] += sign * end
+
+    def measure(self):
+        """
+        Approximates memory used by the index.
+        """
+        nbytes = sys.getsizeof(self.users)
+        for summary in self.users.itervalues():
+            nbytes += sys.getsizeof(summary)
+            for values in summary.itervalues():
+                nbytes += sys.getsizeof(values)
+                nbytes += sum(sys.getsizeof(value) for value in values)
+        return nbytes
+
+    def stats(self):
+        """
+        Returns number of users, build time and size of the index.
+        """
+        return {
+            'users': len(self.users),
+            'build_time': self.build_time,
+            'nbytes': self.nbytes,
+        }
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user_id):
+        """
+        Returns summary of given user or None.
+        """
+        return self.users.get(user_id)
+
+
+def window_bounds(today):
+    """
+    Returns (first, last) day ordinals of common windows ending today.
+    """
+    ordinal = today.toordinal()
+    return {
+        'month': (today.replace(day=1).toordinal(), ordinal),
+        'last_90_days': (ordinal - 89, ordinal),
+    }
+
+
+class WindowSummaries(object):
+    """
+    Weekday summaries of common date windows, see window_bounds().
+
+    Windows are relative to `today`, summaries must be rebuilt when
+    the day changes.
+    """
+
+    def __init__(self, store, today=None):
+        self.today = date.today() if today is None else today
+        self.bounds = window_bounds(self.today)
+        self.summaries = {
+            name: WeekdaySummary(store, first, last)
+            for name, (first, last) in self.bounds.iteritems()
+        }
+
+    def find(self, first, last):
+        """
+        Returns summary of window with given bounds or None.
+        """
+        for name, bounds in self.bounds.iteritems():
+            if bounds == (first, last):
+                return self.summaries[name]
+        return None
+
+    def copy(self):
+        """
+        Returns copy of window summaries, see WeekdaySummary.copy().
+        """
+        windows = copy.copy(self)
+        windows.summaries = {
+            name: summary.copy()
+            for name, summary in self.summaries.iteritems()
+        }
+        return windows
+
+    def apply(self, changes):
+        """
+        Folds changes from PresenceStore.extended into all windows.
+        """
+        for summary in self.summaries.itervalues():
+            summary.apply(changes)
+
+
+class OccupancyIndex(object):
+    """
+    Presence of all users in weekday x 15 minute buckets.
+
+    Entries are added to difference arrays: buckets fully covered by
+    an entry cost one increment at the first of them and one decrement
+    after the last, seconds of partially covered buckets at both ends
+    are added directly. A single sweep over buckets turns these into
+    presence seconds, so building takes one pass over entries whatever
+    their length, and changes can be folded in without a rebuild.
+
+    `occupancy` holds, for every weekday (Monday is 0), mean number of
+    people present in each bucket, averaged over dates of that weekday
+    with any presence. Numbers of these dates are kept in `days`.
+    """
+
+    def __init__(self, entries=()):
+        self.deltas = [[0] * (BUCKETS + 1) for _ in range(7)]
+        self.seconds = [[0] * BUCKETS for _ in range(7)]
+        self.dates = {}
+        for ordinal, start, end in entries:
+            self.add_entry(ordinal, (start, end), 1)
+        self.update()
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Builds index of all entries of PresenceStore.
+        """
+        return cls(chain.from_iterable(
+            izip(user.dates, user.starts, user.ends)
+            for user in (store[user_id] for user_id in store)
+        ))
+
+    def add_entry(self, ordinal, entry, sign):
+        """
+        Adds (start, end) entry of given day, removes it for sign -1.
+
+        Entries which do not end after they start are left out.
+        """
+        start = max(entry[0], 0)
+        end = min(entry[1], BUCKETS * BUCKET_SECONDS)
+        if end <= start:
+            return
+        count = self.dates.get(ordinal, 0) + sign
+        if count:
+            self.dates[ordinal] = count
+        else:
+            del self.dates[ordinal]
+
+        day = weekday(ordinal)
+        seconds = self.seconds[day]
+        first = start // BUCKET_SECONDS
+        last = end // BUCKET_SECONDS
+        if first == last:
+            seconds[first] += sign * (end - start)
+            return
+        seconds[first] += sign * ((first + 1) * BUCKET_SECONDS - start)
+        if last < BUCKETS:
+            seconds[last] += sign * (end - last * BUCKET_SECONDS)
+        deltas = self.deltas[day]
+        deltas[first + 1] += sign
+        deltas[last] -= sign
+
+    def update(self):
+        """
+        Recalculates `occupancy` and `days` from difference arrays.
+        """
+        self.days = [0] * 7
+        for ordinal in self.dates:
+            self.days[weekday(ordinal)] += 1
+        self.occupancy = []
+        for deltas, seconds, days in izip(self.deltas, self.seconds,
+                                          self.days):
+            present = 0
+            row = []
+            for delta, extra in izip(deltas, seconds):
+                present += delta
+                row.append(
+                    float(present * BUCKET_SECONDS + extra) /
+                    (BUCKET_SECONDS * days) if days else 0
+                )
+            self.occupancy.append(row)
+
+    def apply(self, changes):
+        """
+        Folds (user_id, ordinal, old, new) changes from PresenceStore.extended.
+        """
+        for _, ordinal, old, new in changes:
+            if old is not None:
+                self.add_entry(ordinal, old, -1)
+            self.add_entry(ordinal, new, 1)
+        self.update()
+
+    def copy(self):
+        """
+        Returns copy of the index, to which changes can be applied.
+        """
+        index = copy.copy(self)
+        index.deltas = [list(deltas) for deltas in self.deltas]
+        index.seconds = [list(seconds) for seconds in self.seconds]
+        index.dates = dict(self.dates)
+        return index
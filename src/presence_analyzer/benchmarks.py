@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Run `bin/benchmark --users 200 --years 3 --output result.json` to time
+parsing, aggregation and API endpoints on synthetic data, or pass a path
+of existing CSV file to benchmark the parser on it only. Results are
+written as JSON, so that runs can be compared over time.
+"""
+import os
+import csv
+import sys
+import json
+import time
+import random
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape, quoteattr
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+from presence_analyzer.store import to_time
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+
+
+def generate_data(directory, users=100, years=1, seed=0, today=None):
+    """
+    Writes synthetic presence CSV and users XML files into directory.
+
+    Every user is present on working days of given number of years
+    ending today, with random absences and hours. Returns paths of
+    (data.csv, users.xml).
+    """
+    rand = random.Random(seed)
+    today = today or date.today()
+    first = today - timedelta(days=365 * years)
+    csv_path = os.path.join(directory, 'data.csv')
+    xml_path = os.path.join(directory, 'users.xml')
+
+    with open(csv_path, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        for user_id in range(10, 10 + users):
+            day = first
+            while day <= today:
+                if day.weekday() < 5 and rand.random() > 0.1:
+                    start = rand.randint(7 * 3600, 10 * 3600)
+                    end = start + rand.randint(4 * 3600, 10 * 3600)
+                    writer.writerow([
+                        user_id, day.isoformat(),
+                        to_time(start), to_time(end),
+                    ])
+                day += timedelta(days=1)
+
+    with open(xml_path, 'wb') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '<server><host>intranet.example.com</host><port>443</port>'
+            '<protocol>https</protocol></server>\n<users>\n'
+        )
+        for user_id in range(10, 10 + users):
+            xmlfile.write(
+                '<user id=%s><avatar>/api/images/users/%d</avatar>'
+                '<name>%s</name></user>\n' % (
+                    quoteattr(str(user_id)), user_id,
+                    escape('User %d' % user_id),
+                )
+            )
+        xmlfile.write('</users>\n</intranet>\n')
+    return csv_path, xml_path
+
+
+def best_time(function, repeat=3, number=1):
+    """
+    Returns best time, in seconds, of a single call of function.
+    """
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def parse_rows_strptime(rows):
+    """
+    Reference parser calling datetime.strptime three times per row.
+    """
+    for row in rows:
+        if len(row) != 4:
+            continue
+        try:
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+            yield (
+                int(row[0]),
+                datetime.strptime(row[1], '%Y-%m-%d').date().toordinal(),
+                utils.seconds_since_midnight(start),
+                utils.seconds_since_midnight(end),
+            )
+        except (ValueError, TypeError):
+            continue
+
+
+def bench_parser(path=SAMPLE_DATA_CSV, repeat=3):
+    """
+    Compares fast-path row parser with strptime based one.
+
+    Returns best times, in seconds, of parsing all rows of given file.
+    """
+    with open(path, 'rb') as csvfile:
+        rows = list(csv.reader(csvfile, delimiter=','))
+    assert list(utils.parse_rows(rows)) == list(parse_rows_strptime(rows))
+
+    def best(parser):
+        return best_time(lambda: list(parser(rows)), repeat)
+
+    strptime = best(parse_rows_strptime)
+    fast = best(utils.parse_rows)
+    return {
+        'rows': len(rows),
+        'strptime': strptime,
+        'fast': fast,
+        'speedup': strptime / fast,
+    }
+
+
+def cold(function):
+    """
+    Returns function calling given one with all file caches dropped.
+    """
+    def call():
+        for cached in utils.cached_functions:
+            cached.invalidate()
+        return function()
+    return call
+
+
+def bench_loading(repeat=3):
+    """
+    Times loading of configured data files, from scratch and cached.
+    """
+    return {
+        name: {
+            'cold': best_time(cold(function), repeat),
+            'warm': best_time(function, repeat, number=100),
+        }
+        for name, function in (('get_data', utils.get_data),
+                               ('get_store', utils.get_store),
+                               ('get_users', utils.get_users))
+    }
+
+
+def bench_grouping(repeat=3):
+    """
+    Times grouping helpers over entries of all users.
+    """
+    data = utils.get_data()
+    store = utils.get_store()
+    results = {}
+    for function in (utils.group_by_weekday,
+                     utils.group_by_weekday_start_end):
+        results[function.__name__] = {
+            'dict': best_time(
+                lambda: [function(data[user_id]) for user_id in data],
+                repeat),
+            'store': best_time(
+                lambda: [function(store[user_id]) for user_id in store],
+                repeat),
+        }
+    return results
+
+
+def endpoints(user_id):
+    """
+    Returns URLs of API endpoints to benchmark, for given user.
+    """
+    return [
+        '/api/v1/users',
+        '/api/v1/get_avatar/%d' % user_id,
+        '/api/v1/mean_time_weekday/%d' % user_id,
+        '/api/v1/presence_weekday/%d' % user_id,
+        '/api/v1/presence_start_end/%d' % user_id,
+        '/api/v1/presence_weekday/%d?window=last_90_days' % user_id,
+        '/api/v1/presence_weekday/%d?from=%s' % (
+            user_id, (date.today() - timedelta(days=200)).isoformat()),
+        '/api/v1/weekday_stats',
+        '/api/v1/weekday_stats?stream=1',
+        '/api/v1/occupancy',
+    ]
+
+
+def bench_endpoints(repeat=3, number=10):
+    """
+    Times API endpoints via test client, with and without response cache.
+
+    Data files are loaded before timing starts. Returns best time of
+    a single request, in seconds, by URL.
+    """
+    client = app.test_client()
+    user_id = min(utils.get_store())
+    budget = app.config['RESPONSE_CACHE_BYTES']
+
+    def request(url):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        return response.get_data()
+
+    results = {}
+    try:
+        for url in endpoints(user_id):
+            app.config['RESPONSE_CACHE_BYTES'] = 0
+            uncached = best_time(lambda: request(url), repeat, number)
+            app.config['RESPONSE_CACHE_BYTES'] = budget
+            request(url)
+            cached = best_time(lambda: request(url), repeat, number)
+            results[url] = {'uncached': uncached, 'cached': cached}
+    finally:
+        app.config['RESPONSE_CACHE_BYTES'] = budget
+    return results
+
+
+def bench_all(users=100, years=1, repeat=3, seed=0):
+    """
+    Runs all benchmarks on synthetic data of given scale.
+    """
+    directory = tempfile.mkdtemp(prefix='presence-benchmark-')
+    config = dict(app.config)
+    try:
+        csv_path, xml_path = generate_data(directory, users, years, seed)
+        app.config.update({
+            'DATA_CSV': csv_path,
+            'USERS_NAMES': xml_path,
+            'DATA_SNAPSHOT': False,
+            'AVATARS_DIR': None,
+        })
+        return {
+            'parser': bench_parser(csv_path, repeat),
+            'loading': bench_loading(repeat),
+            'grouping': bench_grouping(repeat),
+            'endpoints': bench_endpoints(repeat),
+        }
+    finally:
+        app.config.update(config)
+        for cached in utils.cached_functions:
+            cached.invalidate()
+        shutil.rmtree(directory)
+
+
+def run():
+    """
+    Runs benchmarks and writes their results as JSON.
+    """
+    parser = argparse.ArgumentParser(description=run.__doc__)
+    parser.add_argument('path', nargs='?',
+                        help='benchmark parser only, on given CSV file')
+    parser.add_argument('--users', type=int, default=100,
+                        help='number of users of synthetic data')
+    parser.add_argument('--years', type=int, default=1,
+                        help='years of presence of synthetic data')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of repetitions of each measurement')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of synthetic data generator')
+    parser.add_argument('--output', help='file to write results to')
+    args = parser.parse_args()
+
+    if args.path:
+        results = {'parser': bench_parser(args.path, args.repeat)}
+    else:
+        results = bench_all(args.users, args.years, args.repeat, args.seed)
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': {
+            'path': args.path,
+            'users': args.users,
+            'years': args.years,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    run()
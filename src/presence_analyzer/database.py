@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage of presence data.
+
+Presence entries are kept in a single table, keyed by user and date:
+
+    presence  user_id, day (date ordinal), start and finish (seconds
+              since midnight)
+
+Weekday aggregates are calculated by SQL queries using the primary key
+index, so memory use does not depend on length of presence history.
+"""
+import sqlite3
+import threading
+
+from presence_analyzer.aggregates import WeekdaySummary, OccupancyIndex
+from presence_analyzer.files import atomic_path
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+SCHEMA = '''
+CREATE TABLE presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    finish INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+)
+'''
+
+# day ordinal 1 (0001-01-01) was a Monday
+SUMS_QUERY = '''
+SELECT (day - 1) % 7, COUNT(*), SUM(finish - start), SUM(start), SUM(finish)
+FROM presence
+WHERE user_id = ?{conditions}
+GROUP BY 1
+'''
+
+ENTRIES_QUERY = '''
+SELECT day, start, finish
+FROM presence
+WHERE user_id = ?{conditions}
+ORDER BY day
+'''
+
+ALL_ENTRIES_QUERY = 'SELECT day, start, finish FROM presence'
+
+
+def import_entries(path, entries):
+    """
+    Writes (user_id, ordinal, start, end) tuples into new database at path.
+
+    When the same user and date occur more than once, last entry wins.
+    Database is written to a temporary file and atomically renamed into
+    place, processes using the old one keep reading it until they open
+    the new one. Returns number of imported entries.
+    """
+    with atomic_path(path) as tmp_path:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute(SCHEMA)
+            connection.executemany(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)', entries
+            )
+            count = connection.execute(
+                'SELECT COUNT(*) FROM presence').fetchone()[0]
+            connection.commit()
+        finally:
+            connection.close()
+    log.info('Imported %d entries into %s', count, path)
+    return count
+
+
+class PresenceDatabase(object):
+    """
+    Read access to presence data kept in SQLite database.
+
+    Ids of users are read when database is opened, summaries are queried
+    on demand. Occupancy index is built on first use. Each thread uses
+    its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.user_ids = [
+            row[0] for row in self.execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id')
+        ]
+        self.users = set(self.user_ids)
+        self.occupancy_index = None
+
+    def connect(self):
+        """
+        Returns connection of current thread.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def execute(self, query, parameters=()):
+        """
+        Runs query and returns its cursor.
+        """
+        return self.connect().execute(query, parameters)
+
+    def user_summary(self, user_id, first=None, last=None):
+        """
+        Returns weekday summary of user entries from first to last day.
+
+        Summary has the same structure as the ones of WeekdaySummary,
+        bounds are day ordinals, both inclusive and optional. Returns
+        None for unknown users.
+        """
+        if user_id not in self.users:
+            return None
+        return WeekdaySummary.from_sums(
+            self.query(SUMS_QUERY, user_id, first, last)
+        )
+
+    def entries(self, user_id, first=None, last=None):
+        """
+        Returns cursor of (ordinal, start, end) entries of user, sorted by
+        date, from first to last day, both inclusive and optional.
+        """
+        return self.query(ENTRIES_QUERY, user_id, first, last)
+
+    def occupancy(self):
+        """
+        Returns occupancy index of all entries, see OccupancyIndex.
+        """
+        if self.occupancy_index is None:
+            self.occupancy_index = OccupancyIndex(
+                self.execute(ALL_ENTRIES_QUERY))
+        return self.occupancy_index
+
+    def query(self, query, user_id, first, last):
+        """
+        Runs query of user entries limited to date range.
+        """
+        conditions = ''
+        parameters = [user_id]
+        if first is not None:
+            conditions += ' AND day >= ?'
+            parameters.append(first)
+        if last is not None:
+            conditions += ' AND day <= ?'
+            parameters.append(last)
+        return self.execute(query.format(conditions=conditions), parameters)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def keys(self):
+        """
+        Returns ids of all users.
+        """
+        return list(self.user_ids)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Users directory read from intranet XML export.
+"""
+import locale
+
+from lxml import etree
+
+
+def collation_key(name):
+    """
+    Returns key sorting names according to current locale.
+    """
+    if name is None:
+        return ''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return locale.strxfrm(name)
+
+
+def iter_users(path):
+    """
+    Streams records from users XML file, one element at a time.
+
+    Yields ('server', prefix) when server element ends, prefix being
+    protocol and host of avatar URLs, and ('user', user_id, name, avatar)
+    for every user. Elements are cleared as soon as they are read, so
+    memory use does not grow with the size of the file.
+    """
+    for _, element in etree.iterparse(path, events=('end',),
+                                      tag=('server', 'user')):
+        if element.tag == 'server':
+            yield ('server', '%s://%s' % (element.findtext('protocol'),
+                                          element.findtext('host')))
+        else:
+            yield ('user', element.get('id'), element.findtext('name'),
+                   element.findtext('avatar'))
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class UserDirectory(object):
+    """
+    Names and avatars of users, indexed by user_id given as string.
+
+    Ids ordered by user name are available as `ordered` attribute.
+    """
+
+    def __init__(self, names=None, avatars=None):
+        self.names = {} if names is None else names
+        self.avatars = {} if avatars is None else avatars
+        self.ordered = sorted(
+            self.names, key=lambda user_id: collation_key(self.names[user_id])
+        )
+
+    @classmethod
+    def parse(cls, path):
+        """
+        Parses users XML file with streaming iter_users().
+        """
+        prefix = ''
+        names = {}
+        avatars = {}
+        for record in iter_users(path):
+            if record[0] == 'server':
+                prefix = record[1]
+                continue
+            _, user_id, name, avatar = record
+            names[user_id] = name
+            if avatar is not None:
+                avatars[user_id] = avatar
+
+        avatars = {
+            user_id: prefix + avatar for user_id, avatar in avatars.iteritems()
+        }
+        return cls(names, avatars)
+
+    def __contains__(self, user_id):
+        return user_id in self.names
+
+    def __len__(self):
+        return len(self.names)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Downloading of users XML export and avatar images.
+"""
+import os
+import json
+import time
+import urllib2
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from presence_analyzer.files import atomic_path
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30
+
+
+def validators_path(path):
+    """
+    Returns path of file keeping validators of downloaded file.
+
+    Its mtime is the time the file was last checked for changes.
+    """
+    return path + '.validators'
+
+
+def read_validators(path):
+    """
+    Returns ETag, Last-Modified and Content-Type of last download of path.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(validators_path(path)) as validators:
+            return json.load(validators)
+    except (IOError, ValueError):
+        return {}
+
+
+def replace(path, chunks):
+    """
+    Writes chunks to temporary file and atomically renames it to path.
+
+    Readers of path see either the old or the new file, never a partially
+    written one.
+    """
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'wb') as target:
+            for chunk in chunks:
+                target.write(chunk)
+
+
+def fetch(url, path, chunk_size=CHUNK_SIZE, timeout=TIMEOUT):
+    """
+    Downloads url to path, unless it has not changed since last download.
+
+    Request is made conditional with validators of the previous download,
+    response is streamed in chunks and replaces path atomically. Returns
+    True when path was replaced and False when server answered with 304
+    Not Modified. HTTP and network errors are raised, leaving path intact.
+    """
+    request = urllib2.Request(url)
+    validators = read_validators(path)
+    if validators.get('etag'):
+        request.add_header('If-None-Match', validators['etag'])
+    if validators.get('last_modified'):
+        request.add_header('If-Modified-Since', validators['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.debug('%s not modified', url)
+            os.utime(validators_path(path), None)
+            return False
+        raise
+
+    try:
+        replace(path, iter(lambda: response.read(chunk_size), ''))
+        headers = response.info()
+    finally:
+        response.close()
+    replace(validators_path(path), [json.dumps({
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_type': headers.get('Content-Type'),
+    })])
+    return True
+
+
+def avatar_path(directory, user_id):
+    """
+    Returns path of cached avatar image of given user.
+
+    Ids come from downloaded users XML, so only integer ones are accepted,
+    raises ValueError for others.
+    """
+    return os.path.join(directory, str(int(user_id)))
+
+
+def prefetch_avatars(avatars, directory, workers=4):
+    """
+    Downloads avatar images concurrently, using at most workers threads.
+
+    Avatars are given as {user_id: url} dict and stored in directory,
+    see avatar_path. Users with ids other than integers, and failed
+    downloads, are logged and skipped. Returns {user_id: fetch() result}
+    dict of successful downloads.
+    """
+    def download(item):
+        user_id, url = item
+        try:
+            return user_id, fetch(url, avatar_path(directory, user_id))
+        except (urllib2.URLError, EnvironmentError) as error:
+            log.warning('Cannot download avatar of user %s: %s',
+                        user_id, error)
+            return user_id, None
+
+    items = []
+    for user_id, url in avatars.iteritems():
+        try:
+            avatar_path(directory, user_id)
+        except ValueError:
+            log.warning('Skipping avatar of invalid user id %r', user_id)
+            continue
+        items.append((user_id, url))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(download, items)
+    finally:
+        pool.close()
+        pool.join()
+    return {
+        user_id: result for user_id, result in results if result is not None
+    }
+
+
+class AvatarCache(object):
+    """
+    Avatar images kept in local directory, identified by content hash.
+
+    Images are put into directory by prefetch_avatars() and refreshed
+    lazily: missing ones and ones not checked for max_age seconds are
+    downloaded again, conditionally, by a bounded pool of threads in
+    background, so requests never wait for the intranet.
+    """
+
+    def __init__(self, directory, max_age, workers):
+        self.directory = directory
+        self.max_age = max_age
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.hashes = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, user_id):
+        """
+        Returns path of image of given user.
+        """
+        return avatar_path(self.directory, user_id)
+
+    def version(self, user_id):
+        """
+        Returns content hash of image, None when it is not downloaded yet.
+
+        Hashes are remembered until mtime or size of image changes.
+        """
+        try:
+            stat = os.stat(self.path(user_id))
+        except OSError:
+            return None
+        key = (stat.st_mtime, stat.st_size)
+        cached = self.hashes.get(user_id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        image = self.read(user_id)
+        if image is None:
+            return None
+        self.hashes[user_id] = (key, image[1])
+        return image[1]
+
+    def read(self, user_id):
+        """
+        Returns (data, content hash) of image or None when it is missing.
+        """
+        try:
+            with open(self.path(user_id), 'rb') as image:
+                data = image.read()
+        except IOError:
+            return None
+        return data, hashlib.sha1(data).hexdigest()[:16]
+
+    def content_type(self, user_id):
+        """
+        Returns content type image was served with.
+        """
+        return (read_validators(self.path(user_id)).get('content_type') or
+                'application/octet-stream')
+
+    def is_stale(self, user_id):
+        """
+        Tells whether image was not checked for changes for max_age seconds.
+        """
+        try:
+            checked = os.stat(validators_path(self.path(user_id))).st_mtime
+        except OSError:
+            return True
+        return time.time() - checked > self.max_age
+
+    def refresh(self, user_id, url):
+        """
+        Schedules download of image of given user from url.
+
+        Download of an image is attempted at most once per max_age seconds.
+        Returns AsyncResult of download or None when it was skipped.
+        """
+        with self.lock:
+            attempt = self.attempts.get(user_id)
+            now = time.time()
+            if attempt is not None and now - attempt <= self.max_age:
+                return None
+            self.attempts[user_id] = now
+        return self.pool.apply_async(self.download, (user_id, url))
+
+    def download(self, user_id, url):
+        """
+        Downloads image of given user, logging failures.
+        """
+        try:
+            return fetch(url, self.path(user_id))
+        except (urllib2.URLError, EnvironmentError) as error:
+            log.warning('Cannot download avatar of user %s: %s',
+                        user_id, error)
+            return None
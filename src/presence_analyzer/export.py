@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of presence data as NDJSON or CSV.
+"""
+import csv
+import zlib
+from datetime import date
+from cStringIO import StringIO
+
+from presence_analyzer.utils import get_user_entries, get_user_summary, \
+    json_dumps
+
+CHUNK_SIZE = 64 * 1024
+ENTRY_FIELDS = ('user_id', 'date', 'start', 'end')
+SUMMARY_FIELDS = ('user_id', 'weekday', 'count', 'total', 'mean', 'start',
+                  'end')
+
+
+def format_time(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def entry_records(user_ids, first=None, last=None, data=None):
+    """
+    Yields presence entries of users from first to last day, see
+    ENTRY_FIELDS. Data is read from current_data() unless given.
+    """
+    for user_id in user_ids:
+        for ordinal, start, end in get_user_entries(user_id, first, last,
+                                                    data):
+            yield (user_id, date.fromordinal(ordinal).isoformat(),
+                   format_time(start), format_time(end))
+
+
+def summary_records(user_ids, first=None, last=None, data=None):
+    """
+    Yields weekday aggregates of users from first to last day, one per
+    user and weekday (Monday is 0), see SUMMARY_FIELDS. Data is read from
+    current_data() unless given.
+    """
+    for user_id in user_ids:
+        summary = get_user_summary(user_id, first, last, data)
+        if summary is None:
+            continue
+        for weekday in range(7):
+            yield (user_id, weekday, summary['count'][weekday],
+                   summary['total'][weekday], summary['mean'][weekday],
+                   summary['start'][weekday], summary['end'][weekday])
+
+
+def ndjson_lines(fields, records):
+    """
+    Encodes records as newline delimited JSON objects.
+    """
+    for record in records:
+        yield json_dumps(dict(zip(fields, record))) + '\n'
+
+
+def csv_lines(fields, records):
+    """
+    Encodes records as CSV lines, preceded by a header.
+    """
+    line = StringIO()
+    writer = csv.writer(line, lineterminator='\n')
+    writer.writerow(fields)
+    yield line.getvalue()
+    for record in records:
+        line.seek(0)
+        line.truncate()
+        writer.writerow(record)
+        yield line.getvalue()
+
+
+def buffered(chunks, size=CHUNK_SIZE):
+    """
+    Joins small chunks into ones of at least size bytes.
+    """
+    pending = []
+    length = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(pending)
+            pending = []
+            length = 0
+    if pending:
+        yield ''.join(pending)
+
+
+def gzipped(chunks, level=6):
+    """
+    Compresses chunks into a gzip stream, chunk by chunk.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+    'csv': ('text/csv', csv_lines),
+}
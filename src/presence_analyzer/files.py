@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Atomic replacement of files.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_path(path, mode=0644):
+    """
+    Yields path of new temporary file, renamed to given path on success.
+
+    Temporary file is created empty in the directory of path, so that
+    readers of path see either the old or the new file, never a partially
+    written one. It is removed when the block raises.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp',
+                                        dir=directory)
+    os.close(handle)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
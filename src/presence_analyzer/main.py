@@ -6,3 +6,41 @@ from flask import Flask
 
 
 app = Flask(__name__)
+app.config.update(
+    # max-age, in seconds, of Cache-Control header of API responses
+    API_MAX_AGE=0,
+    # size budget, in bytes, of encoded API responses cache, 0 disables it
+    RESPONSE_CACHE_BYTES=8 * 1024 * 1024,
+    # responses of at least this many bytes are compressed when client
+    # accepts gzip or deflate, None disables compression
+    COMPRESS_MIN_SIZE=1024,
+    # zlib compression level of responses
+    COMPRESS_LEVEL=6,
+    # JSON encoder of API responses: None for stdlib json, name of module
+    # with compatible dumps function, like 'simplejson', or a function
+    JSON_ENCODER=None,
+    # storage of presence data, 'csv' parses DATA_CSV into memory,
+    # 'sqlite' queries DATA_SQLITE database imported from it
+    STORAGE='csv',
+    # processes parsing DATA_CSV files in parallel, 0 uses all CPUs; pool
+    # is forked from a running threaded server, so it is off by default
+    DATA_CSV_WORKERS=1,
+    # keep binary snapshot of parsed DATA_CSV next to it for fast startup
+    DATA_SNAPSHOT=False,
+    # map snapshot columns read-only, sharing them between processes
+    DATA_SNAPSHOT_SHARED=False,
+    # seconds between checks of data files by background refresher,
+    # 0 disables it and data files are checked on each request instead
+    REFRESH_INTERVAL=0,
+    # add Server-Timing header with durations of timed steps to responses
+    SERVER_TIMING=False,
+    # location of users XML export fetched by `download` command
+    USERS_URL='http://bolt/~sargo/users.xml',
+    # directory avatar images are downloaded to and served from,
+    # None leaves avatars on intranet
+    AVATARS_DIR=None,
+    # seconds after which served avatar is checked for changes
+    AVATAR_MAX_AGE=24 * 3600,
+    # number of concurrent avatar downloads
+    DOWNLOAD_WORKERS=4,
+)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Request timing and latency histograms.
+"""
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+from timeit import default_timer as timer
+
+from flask import g, has_request_context, request
+
+from presence_analyzer.main import app
+
+# upper bounds, in seconds, of histogram buckets, last one is unbounded
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+           2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    Count of observed durations in BUCKETS, with their count and sum.
+    """
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """
+        Adds duration, in seconds, to histogram.
+        """
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self):
+        """
+        Returns histogram as dict, buckets as [upper bound, count] pairs.
+        """
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'buckets': [
+                [bound, count]
+                for bound, count in zip(BUCKETS + (None,), self.counts)
+            ],
+        }
+
+
+class Metrics(object):
+    """
+    Process-wide latency histograms of endpoints and timed functions.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.timers = {}
+
+    def observe(self, histograms, name, value):
+        """
+        Adds duration to named histogram, creating it when needed.
+        """
+        with self.lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def to_dict(self):
+        """
+        Returns all histograms, by kind and name.
+        """
+        with self.lock:
+            return {
+                kind: {
+                    name: histogram.to_dict()
+                    for name, histogram in histograms.iteritems()
+                }
+                for kind, histograms in (('endpoints', self.endpoints),
+                                         ('timers', self.timers))
+            }
+
+    def clear(self):
+        """
+        Drops all histograms.
+        """
+        with self.lock:
+            self.endpoints.clear()
+            self.timers.clear()
+
+
+metrics = Metrics()  # pylint: disable-msg=C0103
+
+
+def record(name, elapsed):
+    """
+    Records duration of named step, globally and for current request.
+    """
+    metrics.observe(metrics.timers, name, elapsed)
+    if has_request_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + elapsed
+
+
+def timed(name):
+    """
+    Records duration of each call of wrapped function under given name.
+    """
+    def decorator(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, timer() - start)
+        return inner
+    return decorator
+
+
+def server_timing(timings, total):
+    """
+    Formats Server-Timing header of timed steps, durations in ms.
+    """
+    entries = ['%s;dur=%.3f' % (name, elapsed * 1000)
+               for name, elapsed in timings.iteritems()]
+    entries.append('total;dur=%.3f' % (total * 1000))
+    return ', '.join(entries)
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Starts timing of request.
+    """
+    g.timings = OrderedDict()
+    g.request_start = timer()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records latency of endpoint and adds Server-Timing header if enabled.
+
+    Streamed responses are timed until their body starts being sent.
+    """
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = timer() - start
+    metrics.observe(metrics.endpoints, request.endpoint or 'unknown',
+                    elapsed)
+    if app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = server_timing(g.timings, elapsed)
+    return response
@@ -5,7 +5,6 @@
 import os
 import sys
 from functools import partial
-import urllib
 
 import paste.script.command
 import werkzeug.script
@@ -29,8 +28,11 @@ del _buildout_path
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.utils import start_refresher
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config['REFRESH_INTERVAL'] > 0:
+        start_refresher(app.config['REFRESH_INTERVAL'])
     return app
 
 
@@ -114,7 +116,34 @@ def run():
     werkzeug.script.run()
 
 
+# bin/download
 def download_users():
-    app = make_app()
-    f = open(app.config['USERS_NAMES'], 'w')
-    f.write(urllib.urlopen("http://bolt/~sargo/users.xml").read())
+    from presence_analyzer import app
+    from presence_analyzer.directory import UserDirectory
+    from presence_analyzer.download import fetch, prefetch_avatars
+    app.config.from_pyfile(abspath(DEPLOY_CFG))
+    path = app.config['USERS_NAMES']
+    if fetch(app.config['USERS_URL'], path):
+        print 'Downloaded', path
+    else:
+        print path, 'not modified'
+
+    if app.config['AVATARS_DIR']:
+        avatars = UserDirectory.parse(path).avatars
+        results = prefetch_avatars(avatars, app.config['AVATARS_DIR'],
+                                   app.config['DOWNLOAD_WORKERS'])
+        print 'Downloaded %d of %d avatars, %d not modified' % (
+            sum(results.values()), len(avatars),
+            len(results) - sum(results.values()))
+
+
+# bin/import-sqlite
+def import_sqlite():
+    from presence_analyzer import app
+    from presence_analyzer.database import import_entries
+    from presence_analyzer.utils import csv_paths, read_entries
+    app.config.from_pyfile(abspath(DEPLOY_CFG))
+    paths = csv_paths()
+    count = import_entries(app.config['DATA_SQLITE'], read_entries(paths))
+    print 'Imported %d entries from %d files into %s' % (
+        count, len(paths), app.config['DATA_SQLITE'])
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of parsed presence data.
+
+Snapshot consists of a header, a table of users and fixed-width int32
+columns, all little-endian:
+
+    header  magic, source mtime, size and CRC32, parsing offset and
+            its checksum (see utils.CsvSource), users and records count
+    users   (user_id, number of records) for every user
+    dates   date ordinals of all records, sorted by user and date
+    starts  starts of all records, in seconds since midnight
+    ends    ends of all records, in seconds since midnight
+
+Columns of a snapshot may be mapped into memory without copying, so that
+processes serving the same data share a single copy of it.
+"""
+import os
+import sys
+import mmap
+import zlib
+import fcntl
+import ctypes
+import struct
+from array import array
+from contextlib import contextmanager
+
+from presence_analyzer.files import atomic_path
+from presence_analyzer.store import PresenceStore, UserPresence
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+MAGIC = 'PASNAP02'
+HEADER = struct.Struct('<8sdQIQIII')
+USER = struct.Struct('<ii')
+VALUE = struct.Struct('<i')
+COLUMNS = ('dates', 'starts', 'ends')
+CHUNK_SIZE = 1024 * 1024
+
+
+def snapshot_path(source_path):
+    """
+    Returns path of snapshot kept next to given CSV file.
+    """
+    return source_path + '.snapshot'
+
+
+def file_checksum(path):
+    """
+    Calculates CRC32 checksum of whole file.
+    """
+    checksum = 0
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), ''):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum & 0xffffffff
+
+
+def little_endian(values):
+    """
+    Converts native array to little-endian byte order and back.
+    """
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+@contextmanager
+def exclusive(path):
+    """
+    Holds exclusive lock of snapshot, shared by all processes.
+
+    Lets a single process rebuild the snapshot while others wait for it.
+    """
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def save(path, store, source_path, stat, offset, checksum):
+    """
+    Writes snapshot of store parsed from source_path.
+
+    Stat is the result of os.stat of the source file taken before it was
+    parsed, snapshot is not written when the file has changed since.
+    Offset and checksum describe parsing position in the source file.
+    Snapshot is written to a temporary file and atomically renamed into
+    place, processes which mapped the old one keep using it until they
+    load the new one. Returns True when snapshot was written.
+    """
+    current = os.stat(source_path)
+    if (current.st_mtime, current.st_size) != (stat.st_mtime, stat.st_size):
+        return False
+    user_ids = sorted(store)
+    records = sum(len(store[user_id]) for user_id in user_ids)
+
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(
+                MAGIC, stat.st_mtime, stat.st_size,
+                file_checksum(source_path), offset, checksum & 0xffffffff,
+                len(user_ids), records,
+            ))
+            for user_id in user_ids:
+                snapshot.write(USER.pack(user_id, len(store[user_id])))
+            for column in COLUMNS:
+                for user_id in user_ids:
+                    values = array('i', getattr(store[user_id], column))
+                    little_endian(values).tofile(snapshot)
+    return True
+
+
+def load(path, source_path, shared=False):
+    """
+    Loads store from snapshot if it is still valid for source_path.
+
+    Shared stores keep their columns in the mapped snapshot instead of
+    copying them into arrays, such stores must not be modified. Returns
+    (store, offset, checksum) tuple, or None when snapshot is missing,
+    corrupted or stale.
+    """
+    try:
+        snapshot = open(path, 'rb')
+    except IOError:
+        return None
+    # private mapping is writable for ctypes, but never written to,
+    # so its pages stay shared with page cache and other processes
+    shared = shared and sys.byteorder == 'little'
+    access = mmap.ACCESS_COPY if shared else mmap.ACCESS_READ
+    with snapshot:
+        try:
+            data = mmap.mmap(snapshot.fileno(), 0, access=access)
+        except (ValueError, EnvironmentError):
+            return None
+    try:
+        loaded = read(data, source_path, shared)
+    except ValueError:
+        loaded = None
+    if loaded is None or not shared:
+        data.close()
+    return loaded
+
+
+def read(data, source_path, shared):
+    """
+    Reads store from mapped snapshot, see load().
+    """
+    if len(data) < HEADER.size:
+        return None
+    (magic, mtime, size, source_checksum, offset, checksum, users,
+     records) = HEADER.unpack_from(data)
+    stat = os.stat(source_path)
+    if (magic != MAGIC or mtime != stat.st_mtime or size != stat.st_size or
+            len(data) != HEADER.size + users * USER.size +
+            len(COLUMNS) * records * VALUE.size):
+        return None
+    if source_checksum != file_checksum(source_path):
+        log.info('Snapshot of %s is stale', source_path)
+        return None
+
+    columns_start = HEADER.size + users * USER.size
+    if shared:
+        column = mapped_column
+    else:
+        column = copied_column
+
+    store = {}
+    position = 0
+    for i in xrange(users):
+        user_id, count = USER.unpack_from(data, HEADER.size + i * USER.size)
+        store[user_id] = UserPresence(*[
+            column(data, columns_start + VALUE.size * (j * records + position),
+                   count)
+            for j in range(len(COLUMNS))
+        ])
+        position += count
+
+    store = PresenceStore(store)
+    if shared:
+        store.mapping = data
+    return store, offset, checksum
+
+
+def mapped_column(data, start, count):
+    """
+    Returns int32 values of mapped snapshot, without copying them.
+    """
+    return (ctypes.c_int32 * count).from_buffer(data, start)
+
+
+def copied_column(data, start, count):
+    """
+    Returns int32 values of mapped snapshot, copied into an array.
+    """
+    values = array('i')
+    values.fromstring(data[start:start + count * VALUE.size])
+    return little_endian(values)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed storage of presence data.
+"""
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+def weekday(ordinal):
+    """
+    Returns weekday (Monday is 0) of date given as proleptic ordinal.
+    """
+    return (ordinal - 1) % 7
+
+
+def to_time(seconds):
+    """
+    Converts seconds since midnight to datetime.time object.
+    """
+    return datetime.time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class UserPresence(object):
+    """
+    Presence entries of a single user kept in contiguous arrays.
+
+    Entries are sorted by date. Dates are stored as day ordinals, start
+    and end as seconds since midnight.
+    """
+    __slots__ = ('dates', 'starts', 'ends')
+
+    def __init__(self, dates=None, starts=None, ends=None):
+        self.dates = array('i') if dates is None else dates
+        self.starts = array('i') if starts is None else starts
+        self.ends = array('i') if ends is None else ends
+
+    def __len__(self):
+        return len(self.dates)
+
+    def put(self, ordinal, start, end):
+        """
+        Inserts entry keeping dates sorted, replaces entry of the same date.
+
+        Returns replaced (start, end) tuple or None.
+        """
+        index = bisect_left(self.dates, ordinal)
+        if index < len(self.dates) and self.dates[index] == ordinal:
+            old = (self.starts[index], self.ends[index])
+            self.starts[index] = start
+            self.ends[index] = end
+            return old
+        self.dates.insert(index, ordinal)
+        self.starts.insert(index, start)
+        self.ends.insert(index, end)
+        return None
+
+    def copy(self):
+        """
+        Returns copy of entries with its own arrays.
+        """
+        return UserPresence(array('i', self.dates), array('i', self.starts),
+                            array('i', self.ends))
+
+    @classmethod
+    def merged(cls, parts):
+        """
+        Merges entries of the same user, later parts win on equal dates.
+
+        Parts with consecutive, non-overlapping date ranges, like the ones
+        of monthly files, are concatenated without looking at entries.
+        """
+        parts = [part for part in parts if len(part)]
+        if len(parts) == 1:
+            return parts[0]
+        ordered = sorted(parts, key=lambda part: part.dates[0])
+        if all(previous.dates[-1] < part.dates[0]
+               for previous, part in zip(ordered, ordered[1:])):
+            user = cls()
+            for part in ordered:
+                user.dates.extend(part.dates)
+                user.starts.extend(part.starts)
+                user.ends.extend(part.ends)
+            return user
+
+        days = {}
+        for part in parts:
+            days.update(
+                (ordinal, (start, end))
+                for ordinal, start, end in zip(part.dates, part.starts,
+                                               part.ends)
+            )
+        user = cls()
+        for ordinal in sorted(days):
+            start, end = days[ordinal]
+            user.dates.append(ordinal)
+            user.starts.append(start)
+            user.ends.append(end)
+        return user
+
+    def dump(self):
+        """
+        Returns (dates, starts, ends) arrays as strings, see load().
+        """
+        return (self.dates.tostring(), self.starts.tostring(),
+                self.ends.tostring())
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Creates entries from strings returned by dump().
+        """
+        columns = []
+        for values in dumped:
+            column = array('i')
+            column.fromstring(values)
+            columns.append(column)
+        return cls(*columns)
+
+    def between(self, first=None, last=None):
+        """
+        Returns entries from first to last day ordinal, both inclusive.
+
+        Missing bound leaves range open on that side. Dates are sorted,
+        so range is found by bisection and sliced without a scan.
+        """
+        low = 0 if first is None else bisect_left(self.dates, first)
+        high = len(self) if last is None else bisect_right(self.dates, last)
+        if low == 0 and high == len(self):
+            return self
+        return UserPresence(self.dates[low:high], self.starts[low:high],
+                            self.ends[low:high])
+
+    def weekday_entries(self):
+        """
+        Yields (weekday, start, end) tuples, times in seconds since midnight.
+        """
+        for ordinal, start, end in zip(self.dates, self.starts, self.ends):
+            yield weekday(ordinal), start, end
+
+    def to_dict(self):
+        """
+        Returns entries as {date: {'start': time, 'end': time}} dict.
+        """
+        return {
+            datetime.date.fromordinal(ordinal): {
+                'start': to_time(start),
+                'end': to_time(end),
+            }
+            for ordinal, start, end in zip(self.dates, self.starts, self.ends)
+        }
+
+
+class PresenceStore(object):
+    """
+    Presence data of all users, indexed by user_id.
+
+    Indexes derived from the data, like `summary`, `windows` and
+    `occupancy`, and
+    reading positions in the source files (`sources`) are attached by
+    the loader. Columns kept in a shared memory mapping (`mapping`) are
+    read-only, extended() copies users it changes.
+    """
+
+    def __init__(self, users=None):
+        self.users = {} if users is None else users
+        self.summary = None
+        self.windows = None
+        self.occupancy = None
+        self.sources = []
+        self.mapping = None
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        Builds store from (user_id, ordinal, start, end) tuples.
+
+        When the same user and date occur more than once, last entry wins.
+        """
+        grouped = {}
+        for user_id, ordinal, start, end in entries:
+            grouped.setdefault(user_id, {})[ordinal] = (start, end)
+
+        users = {}
+        for user_id, days in grouped.iteritems():
+            user = users[user_id] = UserPresence()
+            for ordinal in sorted(days):
+                start, end = days[ordinal]
+                user.dates.append(ordinal)
+                user.starts.append(start)
+                user.ends.append(end)
+        return cls(users)
+
+    @classmethod
+    def merged(cls, stores):
+        """
+        Merges stores, later ones win when user and date occur in many.
+        """
+        parts = {}
+        for store in stores:
+            for user_id, user in store.users.iteritems():
+                parts.setdefault(user_id, []).append(user)
+        return cls({
+            user_id: UserPresence.merged(users)
+            for user_id, users in parts.iteritems()
+        })
+
+    def dump(self):
+        """
+        Returns users as {user_id: UserPresence.dump()} dict.
+
+        Strings pickle much faster than arrays, so dumped stores are
+        cheap to pass between processes.
+        """
+        return {
+            user_id: user.dump() for user_id, user in self.users.iteritems()
+        }
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Creates store from dict returned by dump().
+        """
+        return cls({
+            user_id: UserPresence.load(user)
+            for user_id, user in dumped.iteritems()
+        })
+
+    def extended(self, entries):
+        """
+        Returns new store with (user_id, ordinal, start, end) tuples folded in.
+
+        This store is left unchanged, users not present in entries are
+        shared by both stores. Returns (store, changes) tuple, changes
+        being a list of (user_id, ordinal, old, new) tuples, where old is
+        replaced (start, end) tuple or None and new is (start, end).
+        """
+        users = dict(self.users)
+        copied = set()
+        changes = []
+        for user_id, ordinal, start, end in entries:
+            if user_id not in copied:
+                user = users.get(user_id)
+                if user is None:
+                    users[user_id] = UserPresence()
+                else:
+                    users[user_id] = user.copy()
+                copied.add(user_id)
+            old = users[user_id].put(ordinal, start, end)
+            changes.append((user_id, ordinal, old, (start, end)))
+        return PresenceStore(users), changes
+
+    def __getitem__(self, user_id):
+        return self.users[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def keys(self):
+        """
+        Returns ids of all users.
+        """
+        return self.users.keys()
+
+    def to_dict(self):
+        """
+        Returns data in structure produced by utils.get_data().
+        """
+        return {
+            user_id: user.to_dict()
+            for user_id, user in self.users.iteritems()
+        }
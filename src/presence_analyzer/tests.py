@@ -2,14 +2,26 @@
 """
 Presence analyzer unit tests.
 """
+import os
 import os.path
 import json
+import shutil
+import sqlite3
+import tempfile
+import zlib
 import datetime
 import unittest
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
 from presence_analyzer.utils import seconds_since_midnight, mean, interval
 from presence_analyzer.utils import group_by_weekday_start_end, \
     group_by_weekday
-from presence_analyzer import main, utils
+from presence_analyzer import main, utils, aggregates, snapshot, download
+from presence_analyzer import metrics, benchmarks, database
+from presence_analyzer.directory import UserDirectory, iter_users
+from presence_analyzer.store import PresenceStore, UserPresence
 
 
 TEST_DATA_CSV = os.path.join(
@@ -67,6 +79,16 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertIn('<html lang=en>', resp.data)
         self.assertIn('<h2>Presence start-end weekday</h2>', resp.data)
 
+    def test_occupancy(self):
+        """
+        Test occupancy view.
+        """
+        resp = self.client.get('/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<html lang=en>', resp.data)
+        self.assertIn('<h2>Office occupancy by weekday and hour</h2>',
+                      resp.data)
+
     def test_api_users(self):
         """
         Test users listing.
@@ -92,6 +114,362 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(data,
                          'https://intranet.stxnext.pl/api/images/users/10')
 
+    def test_api_conditional_request(self):
+        """
+        Test ETag, Last-Modified and 304 responses of API views.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=0')
+
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get('/api/v1/users',
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get('/api/v1/users',
+                               headers={'If-None-Match': '"other"'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_last_modified_day_change(self):
+        """
+        Test If-Modified-Since of responses built on an earlier day.
+        """
+        url = '/api/v1/presence_weekday/10?window=month'
+        last_modified = self.client.get(url).headers['Last-Modified']
+
+        class Tomorrow(datetime.date):
+            """
+            Date of the day after today.
+            """
+            @classmethod
+            def today(cls):
+                today = datetime.date.today() + datetime.timedelta(days=1)
+                return cls(today.year, today.month, today.day)
+
+        self.addCleanup(setattr, utils, 'date', utils.date)
+        utils.date = Tomorrow
+        resp = self.client.get(url,
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_etag_data_change(self):
+        """
+        Test ETag changes together with data file.
+        """
+        etag = self.client.get('/api/v1/users').headers['ETag']
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+        main.app.config.update({'DATA_CSV': path})
+        resp = self.client.get('/api/v1/users',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_api_max_age(self):
+        """
+        Test Cache-Control max-age taken from config.
+        """
+        main.app.config.update({'API_MAX_AGE': 60})
+        self.addCleanup(main.app.config.update, {'API_MAX_AGE': 0})
+        resp = self.client.get('/api/v1/users')
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=60')
+
+    def test_api_response_cache(self):
+        """
+        Test caching of encoded API responses.
+        """
+        utils.response_cache.clear()
+        hits = utils.response_cache.hits
+        first = self.client.get('/api/v1/presence_weekday/10')
+        second = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(utils.response_cache.hits, hits + 1)
+        self.assertEqual(len(utils.response_cache), 1)
+        self.assertEqual(utils.response_cache.nbytes, len(first.data))
+        self.assertGreater(utils.response_cache.hit_ratio, 0)
+
+        self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(len(utils.response_cache), 2)
+
+    def test_api_response_cache_disabled(self):
+        """
+        Test API responses with response cache disabled.
+        """
+        utils.response_cache.clear()
+        main.app.config.update({'RESPONSE_CACHE_BYTES': 0})
+        self.addCleanup(main.app.config.update,
+                        {'RESPONSE_CACHE_BYTES': 8 * 1024 * 1024})
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(utils.response_cache), 0)
+
+    def test_export_entries(self):
+        """
+        Test streaming export of presence entries.
+        """
+        resp = self.client.get('/api/v1/export/entries')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        self.assertIn('entries.ndjson', resp.headers['Content-Disposition'])
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(json.loads(lines[0]), {
+            'user_id': 10, 'date': '2013-09-10',
+            'start': '09:39:05', 'end': '17:59:52',
+        })
+
+        resp = self.client.get(
+            '/api/v1/export/entries?format=csv&users=11,99&from=2013-09-12'
+        )
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        self.assertEqual(resp.data, 'user_id,date,start,end\n'
+                                    '11,2013-09-12,10:18:36,16:41:25\n'
+                                    '11,2013-09-13,13:16:56,15:04:02\n')
+        resp = self.client.get('/api/v1/export/entries?format=xml')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_export_weekday_stats(self):
+        """
+        Test streaming export of weekday aggregates, compressed.
+        """
+        resp = self.client.get('/api/v1/export/weekday_stats?format=csv',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        lines = zlib.decompress(resp.data, 16 + zlib.MAX_WBITS).splitlines()
+        self.assertEqual(len(lines), 1 + 2 * 7)
+        self.assertEqual(lines[0], 'user_id,weekday,count,total,mean,'
+                                   'start,end')
+        self.assertEqual(lines[11], '11,3,2,45968,22984.0,35602.0,58586.0')
+
+        resp = self.client.get('/api/v1/export/weekday_stats?users=10')
+        records = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([record['weekday'] for record in records],
+                         range(7))
+        self.assertEqual(records[1]['total'], 30047)
+
+    def test_metrics_view(self):
+        """
+        Test latency histograms and cache statistics.
+        """
+        metrics.metrics.clear()
+        utils.response_cache.clear()
+        hits = utils.response_cache.hits
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get('/api/v1/_metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        data = json.loads(resp.data)
+        endpoint = data['endpoints']['presence_weekday_view']
+        self.assertEqual(endpoint['count'], 2)
+        self.assertEqual(sum(count for _, count in endpoint['buckets']), 2)
+        self.assertIsNone(endpoint['buckets'][-1][0])
+        self.assertEqual(data['timers']['encode']['count'], 1)
+        self.assertEqual(data['timers']['summarize']['count'], 1)
+        self.assertEqual(data['caches']['responses']['hits'], hits + 1)
+        self.assertEqual(data['caches']['responses']['entries'], 1)
+        self.assertEqual(data['caches']['responses']['nbytes'],
+                         utils.response_cache.nbytes)
+        self.assertGreater(utils.response_cache.nbytes, 0)
+        self.assertIn('get_store', data['caches'])
+        summary = utils.get_summary()
+        self.assertEqual(data['indexes']['summary'], {
+            'users': 2,
+            'build_time': summary.build_time,
+            'nbytes': summary.nbytes,
+        })
+        self.assertItemsEqual(data['indexes']['windows'].keys(),
+                              ['month', 'last_90_days'])
+        self.assertGreater(
+            data['indexes']['windows']['month']['nbytes'], 0)
+
+    def test_server_timing(self):
+        """
+        Test Server-Timing header of timed steps.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertNotIn('Server-Timing', resp.headers)
+        main.app.config.update({'SERVER_TIMING': True})
+        self.addCleanup(main.app.config.update, {'SERVER_TIMING': False})
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        entries = [entry.split(';')[0]
+                   for entry in resp.headers['Server-Timing'].split(', ')]
+        self.assertEqual(entries, ['summarize', 'encode', 'total'])
+
+    def test_api_compression(self):
+        """
+        Test compression of API responses and caching of compressed ones.
+        """
+        main.app.config.update({'COMPRESS_MIN_SIZE': 512})
+        self.addCleanup(main.app.config.update, {'COMPRESS_MIN_SIZE': 1024})
+        utils.response_cache.clear()
+        plain = self.client.get('/api/v1/weekday_stats')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertGreater(len(plain.data), 512)
+        nbytes = utils.response_cache.nbytes
+
+        resp = self.client.get('/api/v1/weekday_stats',
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS),
+                         plain.data)
+        self.assertEqual(utils.response_cache.nbytes,
+                         nbytes + len(resp.data))
+        again = self.client.get('/api/v1/weekday_stats',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(again.data, resp.data)
+        self.assertEqual(utils.response_cache.nbytes,
+                         nbytes + len(resp.data))
+
+        resp = self.client.get('/api/v1/weekday_stats',
+                               headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(resp.data), plain.data)
+
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_api_json_encoder(self):
+        """
+        Test compact JSON and pluggable JSON encoder.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertNotIn(', ', resp.data)
+        main.app.config.update({'JSON_ENCODER': 'json'})
+        self.addCleanup(main.app.config.update, {'JSON_ENCODER': None})
+        utils.response_cache.clear()
+        self.assertEqual(
+            self.client.get('/api/v1/mean_time_weekday/10').data, resp.data
+        )
+        main.app.config.update({'JSON_ENCODER': 'missing_json_module'})
+        utils.response_cache.clear()
+        self.assertEqual(
+            self.client.get('/api/v1/mean_time_weekday/10').data, resp.data
+        )
+        main.app.config.update({'JSON_ENCODER': lambda value: '"plugged"'})
+        utils.response_cache.clear()
+        self.assertEqual(
+            self.client.get('/api/v1/mean_time_weekday/10').data,
+            '"plugged"',
+        )
+
+    def test_weekday_stats_view(self):
+        """
+        Test batch weekday statistics of all users.
+        """
+        resp = self.client.get('/api/v1/weekday_stats')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertItemsEqual(data['11'].keys(), [
+            'mean_time_weekday', 'presence_weekday', 'presence_start_end',
+        ])
+        single = self.client.get('/api/v1/presence_start_end/11')
+        self.assertEqual(data['11']['presence_start_end'],
+                         json.loads(single.data))
+
+    def test_weekday_stats_view_args(self):
+        """
+        Test batch weekday statistics of chosen users and metrics.
+        """
+        resp = self.client.get(
+            '/api/v1/weekday_stats?users=11,99&metrics=presence_weekday'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data.keys(), ['11'])
+        self.assertEqual(data['11'].keys(), ['presence_weekday'])
+
+        resp = self.client.get('/api/v1/weekday_stats?users=x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/weekday_stats?metrics=other')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_weekday_stats_view_stream(self):
+        """
+        Test streamed batch weekday statistics.
+        """
+        resp = self.client.get('/api/v1/weekday_stats?stream=1')
+        self.assertEqual(resp.status_code, 200)
+        expected = self.client.get('/api/v1/weekday_stats')
+        self.assertEqual(json.loads(resp.data), json.loads(expected.data))
+
+    def test_stream_data_reload(self):
+        """
+        Test streamed responses read data loaded when the request came.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-16,09:00:00,17:00:00\n'
+                          '11,2013-09-16,09:00:00,17:00:00\n')
+        for url in ('/api/v1/weekday_stats?stream=1',
+                    '/api/v1/export/weekday_stats?format=csv',
+                    '/api/v1/export/entries?format=csv'):
+            expected = self.client.get(url).data
+            resp = self.client.get(url)
+            main.app.config.update({'DATA_CSV': path})
+            self.assertEqual(resp.data, expected)
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def test_presence_weekday_view_date_range(self):
+        """
+        Test weekday metrics limited to a date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([row[1] for row in data[1:]],
+                         [0, 16564, 25321, 22969, 0, 0, 0])
+
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-09-13')
+        data = json.loads(resp.data)
+        self.assertEqual([row[1] for row in data[1:]],
+                         [0, 0, 0, 0, 6426, 0, 0])
+
+        resp = self.client.get('/api/v1/presence_weekday/11?window=month')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([row[1] for row in data[1:]], [0] * 7)
+
+    def test_date_range_invalid(self):
+        """
+        Test invalid date range parameters.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/11?from=yesterday')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_weekday/11?window=decade')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_weekday_stats_view_date_range(self):
+        """
+        Test batch weekday statistics limited to a date range.
+        """
+        resp = self.client.get('/api/v1/weekday_stats?to=2013-09-09'
+                               '&metrics=presence_weekday&stream=1')
+        data = json.loads(resp.data)
+        self.assertEqual([row[1] for row in data['10']['presence_weekday']],
+                         ['Presence (s)', 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(data['11']['presence_weekday'][1][1], 24123)
+
     def test_mean_time_weekday_view(self):
         """
         Test day abbr
@@ -118,6 +496,22 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(0, data[1][1])
         self.assertEqual(23705, data[4][1])
 
+    def test_occupancy_view(self):
+        """
+        Test occupancy heatmap of all users.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertEqual(len(data[0]), 97)
+        self.assertEqual(data[0][:2], ['Weekday', '00:00'])
+        self.assertEqual(data[0][39], '09:30')
+        # Tuesday: user 10 arrives at 09:39:05, user 11 at 09:19:50
+        self.assertEqual(data[2][37:42], [0, 0.68, 1.39, 2.0, 2.0])
+        self.assertEqual(max(data[7][1:]), 0)
+
     def test_presence_start_end_view(self):
         """
         Test presence start end views
@@ -162,6 +556,345 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data[10][sample_date]['start'],
                          datetime.time(9, 39, 5))
 
+    def test_get_data_cache(self):
+        """
+        Test caching of parsed CSV file.
+        """
+        cache = utils.get_data.cache
+        utils.get_data.invalidate()
+        misses = cache.misses
+        hits = cache.hits
+        data = utils.get_data()
+        self.assertIs(utils.get_data(), data)
+        self.assertEqual(cache.misses, misses + 1)
+        self.assertEqual(cache.hits, hits + 1)
+
+        utils.get_data.invalidate()
+        self.assertIsNot(utils.get_data(), data)
+        self.assertEqual(cache.misses, misses + 2)
+
+    def test_get_data_cache_file_change(self):
+        """
+        Test reloading of cached data when CSV file changes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+
+    def test_get_store_append(self):
+        """
+        Test folding of lines appended to CSV file into loaded store.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        stale = utils.get_store()
+        stale_data = stale.to_dict()
+        stale_summary = stale.summary.users.copy()
+        refreshes = utils.get_store.cache.refreshes
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '\n12,2013-09-16,09:00:00,17:00:00'
+                '\n11,2013-09-05,08:00:00,16:00:00'
+                '\n11,2013-09-19,09:00:00,15:00:00\n'
+            )
+        store = utils.get_store()
+        self.assertIsNot(store, stale)
+        self.assertEqual(utils.get_store.cache.refreshes, refreshes + 1)
+        self.assertEqual(stale.to_dict(), stale_data)
+        self.assertEqual(stale.summary.users, stale_summary)
+        self.assertIs(store[10], stale[10])
+        self.assertItemsEqual(store.keys(), [10, 11, 12])
+        self.assertEqual(store.summary.get(12)['total'][0], 28800)
+        thursday = datetime.date(2013, 9, 5)
+        self.assertEqual(store[11].to_dict()[thursday],
+                         {'start': datetime.time(8, 0, 0),
+                          'end': datetime.time(16, 0, 0)})
+
+        incremental = store.summary.users
+        utils.get_store.invalidate()
+        reloaded = utils.get_store()
+        self.assertIsNot(reloaded, store)
+        self.assertEqual(reloaded.to_dict(), store.to_dict())
+        self.assertEqual(reloaded.summary.users, incremental)
+        self.assertEqual(reloaded.occupancy.occupancy,
+                         store.occupancy.occupancy)
+        self.assertNotEqual(stale.occupancy.occupancy,
+                            store.occupancy.occupancy)
+
+    def test_csv_source_tail(self):
+        """
+        Test detection of rewrites by checksum of tail before offset.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        line = '10,2013-09-10,09:00:00,17:00:00\n'
+        with open(path, 'wb') as csvfile:
+            csvfile.write(line * 3000)
+        source = utils.CsvSource(path)
+        self.assertEqual(len(list(source.read())), 3000)
+        self.assertIsNotNone(source.tail)
+        self.assertGreater(source.offset, utils.CsvSource.TAIL_SIZE)
+
+        with open(path, 'ab') as csvfile:
+            csvfile.write(line)
+        self.assertTrue(source.is_appended())
+        with open(path, 'r+b') as csvfile:
+            csvfile.seek(source.offset - 3)
+            csvfile.write('9')
+        self.assertFalse(source.is_appended())
+
+        # without tail checksum, whole parsed part is compared
+        untracked = utils.CsvSource(path, source.offset, source.checksum)
+        self.assertFalse(untracked.is_appended())
+
+    def test_refresher(self):
+        """
+        Test background refresher publishing reloaded data.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+
+        refresher = utils.Refresher(3600)
+        refresher.start()
+        self.addCleanup(refresher.stop)
+        self.assertTrue(utils.get_store.cache.background)
+        store = utils.get_store()
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+        self.assertIs(utils.get_store(), store)
+
+        refresher.refresh()
+        self.assertIn(12, utils.get_store())
+        self.assertIn(12, utils.get_summary())
+
+        refresher.stop()
+        refresher.join(1)
+        self.assertFalse(refresher.is_alive())
+        self.assertFalse(utils.get_store.cache.background)
+
+    def test_get_store_rewrite(self):
+        """
+        Test full reload of store when CSV file is rewritten.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        store = utils.get_store()
+        refreshes = utils.get_store.cache.refreshes
+
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-16,09:00:00,17:00:00\n')
+        reloaded = utils.get_store()
+        self.assertIsNot(reloaded, store)
+        self.assertEqual(utils.get_store.cache.refreshes, refreshes)
+        self.assertItemsEqual(reloaded.keys(), [12])
+
+    def write_shards(self):
+        """
+        Splits test data into two CSV files, second one overriding a day.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.addCleanup(main.app.config.update, {'DATA_CSV_WORKERS': 1})
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            lines = csvfile.read().splitlines()
+        paths = []
+        for name, shard in (('data-1.csv', lines[::2]),
+                            ('data-2.csv', lines[1::2] + [
+                                '10,2013-09-10,08:00:00,16:00:00'])):
+            paths.append(os.path.join(tmp_dir, name))
+            with open(paths[-1], 'wb') as csvfile:
+                csvfile.write('\n'.join(shard) + '\n')
+        return tmp_dir, paths
+
+    def test_get_store_shards(self):
+        """
+        Test parallel parsing of many CSV files.
+        """
+        tmp_dir, paths = self.write_shards()
+        main.app.config.update({
+            'DATA_CSV': os.path.join(tmp_dir, 'data-*.csv'),
+            'DATA_CSV_WORKERS': 2,
+        })
+        self.assertEqual(utils.csv_paths(), paths)
+        store = utils.get_store()
+        self.assertEqual([source.path for source in store.sources], paths)
+        self.assertEqual(list(store[10].starts), [28800, 33592, 38926])
+        self.assertEqual(list(store[11].dates), sorted(store[11].dates))
+        self.assertEqual(utils.get_summary().get(11)['total'][3], 45968)
+
+        main.app.config.update({'DATA_CSV': paths, 'DATA_CSV_WORKERS': 1})
+        utils.get_store.invalidate()
+        self.assertEqual(utils.get_store().to_dict(), store.to_dict())
+        main.app.config.update({'DATA_CSV': paths[::-1]})
+        self.assertEqual(list(utils.get_store()[10].starts),
+                         [34745, 33592, 38926])
+
+    def test_get_store_shards_default_workers(self):
+        """
+        Test many CSV files are parsed without process pool by default.
+        """
+        tmp_dir, paths = self.write_shards()
+        self.assertEqual(main.app.config['DATA_CSV_WORKERS'], 1)
+        main.app.config.update({'DATA_CSV': paths})
+
+        def pool(*args, **kwargs):
+            raise AssertionError('process pool started')
+
+        self.addCleanup(setattr, utils.multiprocessing, 'Pool',
+                        utils.multiprocessing.Pool)
+        utils.multiprocessing.Pool = pool
+        self.assertEqual(list(utils.get_store()[10].starts),
+                         [28800, 33592, 38926])
+
+    def test_get_store_shards_append(self):
+        """
+        Test refreshing of store parsed from many CSV files.
+        """
+        tmp_dir, paths = self.write_shards()
+        main.app.config.update({'DATA_CSV': os.path.join(tmp_dir, '*.csv')})
+        utils.get_store()
+        refreshes = utils.get_store.cache.refreshes
+        with open(paths[1], 'a') as csvfile:
+            csvfile.write('12,2013-09-16,09:00:00,17:00:00\n')
+        self.assertIn(12, utils.get_store())
+        self.assertEqual(utils.get_store.cache.refreshes, refreshes + 1)
+
+        with open(paths[0], 'a') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+        store = utils.get_store()
+        self.assertEqual(utils.get_store.cache.refreshes, refreshes + 1)
+        self.assertEqual(store[10].starts[0], 28800)
+
+        with open(os.path.join(tmp_dir, 'data-3.csv'), 'wb') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+        self.assertEqual(utils.get_store()[10].starts[0], 32400)
+
+    def test_get_store_shards_unterminated(self):
+        """
+        Test refreshing when an earlier CSV file lacks final newline.
+        """
+        tmp_dir, paths = self.write_shards()
+        with open(paths[0], 'rb') as csvfile:
+            content = csvfile.read()
+        with open(paths[0], 'wb') as csvfile:
+            csvfile.write(content.rstrip('\n'))
+        main.app.config.update({'DATA_CSV': paths})
+        store = utils.get_store()
+        refreshes = utils.get_store.cache.refreshes
+        for user_id in (12, 13, 14):
+            with open(paths[1], 'a') as csvfile:
+                csvfile.write('%d,2013-09-16,09:00:00,17:00:00\n' % user_id)
+            self.assertIn(user_id, utils.get_store())
+        self.assertEqual(utils.get_store.cache.refreshes, refreshes + 3)
+        self.assertEqual(utils.get_store()[11].to_dict(),
+                         store[11].to_dict())
+
+    def test_merged(self):
+        """
+        Test merging of stores, later ones winning on conflicts.
+        """
+        first = PresenceStore.from_entries([(10, 1, 0, 10), (10, 3, 0, 30),
+                                            (11, 1, 0, 10)])
+        second = PresenceStore.from_entries([(10, 2, 0, 20), (10, 3, 5, 35),
+                                             (12, 2, 0, 20)])
+        merged = PresenceStore.merged([first, second])
+        self.assertItemsEqual(merged.keys(), [10, 11, 12])
+        self.assertEqual(list(merged[10].dates), [1, 2, 3])
+        self.assertEqual(list(merged[10].starts), [0, 0, 5])
+        self.assertIs(merged[11], first[11])
+
+        later = PresenceStore.from_entries([(10, 4, 0, 40)])
+        merged = PresenceStore.merged([later, first])
+        self.assertEqual(list(merged[10].ends), [10, 30, 40])
+        loaded = PresenceStore.load(merged.dump())
+        self.assertEqual(loaded.to_dict(), merged.to_dict())
+
+    def test_get_store(self):
+        """
+        Test parsing of CSV file into PresenceStore.
+        """
+        store = utils.get_store()
+        self.assertItemsEqual(store.keys(), [10, 11])
+        self.assertIn(10, store)
+        user = store[10]
+        self.assertEqual(len(user), 3)
+        self.assertEqual(user.dates[0], datetime.date(2013, 9, 10).toordinal())
+        self.assertEqual(user.starts[0], 34745)
+        self.assertEqual(user.ends[0], 64792)
+        self.assertEqual(store.to_dict(), utils.get_data())
+
+    def test_group_by_weekday_store(self):
+        """
+        Test grouping of PresenceStore entries by weekday.
+        """
+        weekdays = group_by_weekday(utils.get_store()[11])
+        self.assertEqual([24123], weekdays[0])
+        self.assertEqual([22999, 22969], weekdays[3])
+
+        result_start, result_stop = group_by_weekday_start_end(
+            utils.get_store()[11]
+        )
+        self.assertEqual([33134], result_start[0])
+        self.assertEqual([57257], result_stop[0])
+        self.assertEqual([34088, 37116], result_start[3])
+        self.assertEqual([57087, 60085], result_stop[3])
+
+    def test_parse_date(self):
+        """
+        Test parsing of dates into day ordinals.
+        """
+        expected = datetime.date(2013, 9, 5).toordinal()
+        self.assertEqual(utils.parse_date('2013-09-05'), expected)
+        self.assertEqual(utils.parse_date('2013-9-5'), expected)
+        self.assertRaises(ValueError, utils.parse_date, '2013-02-30')
+        self.assertRaises(ValueError, utils.parse_date, '2013-09-0x')
+        self.assertRaises(ValueError, utils.parse_date, '')
+
+    def test_parse_time(self):
+        """
+        Test parsing of times into seconds since midnight.
+        """
+        self.assertEqual(utils.parse_time('09:39:05'), 34745)
+        self.assertEqual(utils.parse_time('9:39:05'), 34745)
+        self.assertEqual(utils.parse_time('23:59:59'), 86399)
+        self.assertRaises(ValueError, utils.parse_time, '24:00:00')
+        self.assertRaises(ValueError, utils.parse_time, '10:00:60')
+        self.assertRaises(ValueError, utils.parse_time, '-1:00:00')
+
+    def test_parse_rows(self):
+        """
+        Test skipping of malformed rows.
+        """
+        rows = [
+            ['user_id', 'date', 'start', 'end'],
+            ['10', '2013-09-10', '09:39:05', '17:59:52'],
+            ['10', '2013-09-11', 'xx:19:52', '16:07:37'],
+            ['x', '2013-09-12', '10:48:46', '17:23:51'],
+            ['11'],
+        ]
+        self.assertEqual(
+            list(utils.parse_rows(rows)),
+            [(10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)],
+        )
+
     def test_get_users(self):
         """
         Test getting users
@@ -180,6 +913,80 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data['10'],
                          'https://intranet.stxnext.pl/api/images/users/10')
 
+    def test_get_directory(self):
+        """
+        Test users directory parsed once from XML file.
+        """
+        directory = utils.get_directory()
+        self.assertIs(utils.get_directory(), directory)
+        self.assertIn('10', directory)
+        self.assertEqual(len(directory), 1)
+        self.assertEqual(directory.names, {'10': u'Maciej Zięba'})
+        self.assertEqual(directory.ordered, ['10'])
+        self.assertIs(utils.get_users(), directory.names)
+        self.assertIs(utils.get_avatars(), directory.avatars)
+
+    def test_user_directory_order(self):
+        """
+        Test ordering of users by name.
+        """
+        directory = UserDirectory(
+            {'1': u'Zenon', '2': u'Adam', '3': u'Maria'},
+        )
+        self.assertEqual(directory.ordered, ['2', '3', '1'])
+        self.assertEqual(directory.avatars, {})
+
+    def test_iter_users(self):
+        """
+        Test streaming of users XML file.
+        """
+        records = list(iter_users(TEST_USERS_NAMES))
+        self.assertEqual(records, [
+            ('server', 'https://intranet.stxnext.pl'),
+            ('user', '10', u'Maciej Zięba', '/api/images/users/10'),
+        ])
+
+    def test_user_directory_server_last(self):
+        """
+        Test avatar URLs when server element follows users.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'users.xml')
+        with open(path, 'w') as xml:
+            xml.write(
+                '<intranet><users>'
+                '<user id="1"><avatar>/a/1</avatar><name>A</name></user>'
+                '<user id="2"><name>B</name></user>'
+                '</users><server><host>h</host><protocol>http</protocol>'
+                '</server></intranet>'
+            )
+        directory = UserDirectory.parse(path)
+        self.assertEqual(directory.names, {'1': 'A', '2': 'B'})
+        self.assertEqual(directory.avatars, {'1': 'http://h/a/1'})
+
+    def test_get_users_listing(self):
+        """
+        Test cached JSON listing of users.
+        """
+        listing = utils.get_users_listing()
+        self.assertIsInstance(listing, utils.RawJSON)
+        self.assertIs(utils.get_users_listing(), listing)
+        self.assertEqual(json.loads(listing),
+                         [{u'user_id': u'10', u'name': u'Maciej Zięba'}])
+
+    def test_get_users_listing_reload(self):
+        """
+        Test rebuilding of users listing when data file changes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-16,09:00:00,17:00:00\n')
+        main.app.config.update({'DATA_CSV': path})
+        self.assertEqual(json.loads(utils.get_users_listing()), [])
+
     def test_group_by_weekday(self):
         """
         Test group by weekday
@@ -208,6 +1015,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         end = datetime.time(3, 2, 3)
         result = interval(start, end)
         self.assertEqual(3541, result)
+        self.assertEqual(3541, interval(7382, 10923))
 
     def test_mean(self):
         """
@@ -228,6 +1036,685 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual([37116, 34088], result_start[3])
         self.assertEqual([60085, 57087], result_stop[3])
 
+    def test_timed(self):
+        """
+        Test recording of durations of timed functions.
+        """
+        metrics.metrics.clear()
+        utils.group_by_weekday(utils.get_data()[10])
+        utils.group_by_weekday(utils.get_data()[11])
+        histogram = metrics.metrics.timers['group_by_weekday']
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(sum(histogram.counts), 2)
+        self.assertIn('get_data', metrics.metrics.timers)
+        self.assertEqual(utils.group_by_weekday.__name__, 'group_by_weekday')
+
+    def test_generate_data(self):
+        """
+        Test synthetic data generator of benchmarks.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        csv_path, xml_path = benchmarks.generate_data(
+            tmp_dir, users=3, years=1, today=datetime.date(2013, 9, 13)
+        )
+        main.app.config.update({'DATA_CSV': csv_path,
+                                'USERS_NAMES': xml_path})
+        store = utils.get_store()
+        self.assertItemsEqual(store.keys(), [10, 11, 12])
+        self.assertEqual(utils.get_users()['12'], 'User 12')
+        dates = [datetime.date.fromordinal(ordinal)
+                 for ordinal in store[10].dates]
+        self.assertGreater(len(dates), 200)
+        self.assertTrue(all(day.weekday() < 5 for day in dates))
+        self.assertEqual(
+            benchmarks.generate_data(tmp_dir, users=3, years=1,
+                                     today=datetime.date(2013, 9, 13)),
+            (csv_path, xml_path),
+        )
+        self.assertEqual(utils.get_store().to_dict(), store.to_dict())
+
+    def test_response_cache_eviction(self):
+        """
+        Test LRU eviction of response cache above byte budget.
+        """
+        cache = utils.ResponseCache()
+        cache.put('v1', 'a', 'aaaa', 10)
+        cache.put('v1', 'b', 'bbbb', 10)
+        self.assertEqual(cache.get('v1', 'a'), 'aaaa')
+        cache.put('v1', 'c', 'cccc', 10)
+        self.assertIsNone(cache.get('v1', 'b'))
+        self.assertEqual(cache.get('v1', 'a'), 'aaaa')
+        self.assertEqual(cache.nbytes, 8)
+        cache.put('v1', 'd', 'd' * 11, 10)
+        self.assertIsNone(cache.get('v1', 'd'))
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hit_ratio, 0.5)
+
+    def test_response_cache_variants(self):
+        """
+        Test counting of compressed variants into response cache size.
+        """
+        cache = utils.ResponseCache()
+        payload = utils.Payload('aaaa', 'a')
+        cache.put('v1', 'a', payload, 10)
+        cache.add_variant(payload, 'gzip', 'zz', 10)
+        self.assertEqual(cache.nbytes, 6)
+        cache.put('v1', 'b', utils.Payload('bbbb', 'b'), 9)
+        self.assertIsNone(cache.get('v1', 'a'))
+        self.assertEqual(cache.nbytes, 4)
+        cache.add_variant(payload, 'deflate', 'dd', 10)
+        self.assertEqual(cache.nbytes, 4)
+        self.assertEqual(utils.payload_size(payload), 8)
+
+    def test_response_cache_version(self):
+        """
+        Test dropping of cached responses when data version changes.
+        """
+        cache = utils.ResponseCache()
+        cache.put('v1', 'a', 'aaaa', 10)
+        self.assertIsNone(cache.get('v2', 'a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({'DATA_CSV': self.path})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': False,
+                                'DATA_SNAPSHOT_SHARED': False})
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        """
+        Test snapshot round trip.
+        """
+        store = utils.get_store()
+        path = snapshot.snapshot_path(self.path)
+        self.assertTrue(snapshot.save(
+            path, store, self.path, os.stat(self.path),
+            store.sources[0].offset, store.sources[0].checksum,
+        ))
+        loaded, offset, checksum = snapshot.load(path, self.path)
+        self.assertEqual(loaded.to_dict(), store.to_dict())
+        self.assertEqual(offset, store.sources[0].offset)
+        self.assertEqual(checksum, store.sources[0].checksum)
+
+    def test_save_error(self):
+        """
+        Test failed snapshot leaves no temporary file behind.
+        """
+        store = PresenceStore({10: UserPresence(['x'], [0], [10])})
+        path = snapshot.snapshot_path(self.path)
+        self.assertRaises(TypeError, snapshot.save, path, store, self.path,
+                          os.stat(self.path), 0, 0)
+        self.assertEqual(os.listdir(self.tmp_dir), ['data.csv'])
+
+    def test_load_stale(self):
+        """
+        Test rejecting of stale or missing snapshots.
+        """
+        path = snapshot.snapshot_path(self.path)
+        self.assertIsNone(snapshot.load(path, self.path))
+        store = utils.get_store()
+        snapshot.save(path, store, self.path, os.stat(self.path), 0, 0)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+        self.assertIsNone(snapshot.load(path, self.path))
+
+        with open(path, 'wb') as corrupted:
+            corrupted.write('garbage')
+        self.assertIsNone(snapshot.load(path, self.path))
+
+    def test_get_store_snapshot(self):
+        """
+        Test loading of store from snapshot written on first load.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': True})
+        utils.get_store.invalidate()
+        store = utils.get_store()
+        path = snapshot.snapshot_path(self.path)
+        self.assertTrue(os.path.exists(path))
+
+        utils.get_store.invalidate()
+        loaded = utils.get_store()
+        self.assertIsNot(loaded, store)
+        self.assertEqual(loaded.to_dict(), store.to_dict())
+        self.assertEqual(loaded.summary.users, store.summary.users)
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+        self.assertIn(12, utils.get_store())
+
+    def test_get_store_snapshot_unwritable(self):
+        """
+        Test parsing without snapshot when its lock cannot be opened.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': True})
+        utils.get_store.invalidate()
+        path = snapshot.snapshot_path(self.path)
+        # opening a directory for writing fails like a read-only one
+        os.mkdir(path + '.lock')
+        store = utils.get_store()
+        self.assertItemsEqual(store.keys(), [10, 11])
+        self.assertFalse(os.path.exists(path))
+        resp = main.app.test_client().get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_load_shared(self):
+        """
+        Test mapping of snapshot columns without copying.
+        """
+        store = utils.get_store()
+        path = snapshot.snapshot_path(self.path)
+        snapshot.save(path, store, self.path, os.stat(self.path), 0, 0)
+        shared, _, _ = snapshot.load(path, self.path, shared=True)
+        self.assertIsNotNone(shared.mapping)
+        self.assertEqual(shared.to_dict(), store.to_dict())
+        self.assertEqual(list(shared[11].between(*store[11].dates[1:3])
+                              .starts), list(store[11].starts[1:3]))
+
+    def test_get_store_shared(self):
+        """
+        Test reloading of shared snapshot when CSV file changes.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': True,
+                                'DATA_SNAPSHOT_SHARED': True})
+        utils.get_store.invalidate()
+        store = utils.get_store()
+        self.assertIsNotNone(store.mapping)
+        self.assertEqual(utils.get_summary().get(11)['total'][3], 45968)
+
+        refreshes = utils.get_store.cache.refreshes
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,09:00:00,17:00:00'
+                          '\n11,2013-09-05,08:00:00,16:00:00\n')
+        refreshed = utils.get_store()
+        self.assertIsNot(refreshed, store)
+        self.assertEqual(utils.get_store.cache.refreshes, refreshes + 1)
+        self.assertIs(refreshed.mapping, store.mapping)
+        self.assertIs(refreshed[10], store[10])
+        self.assertIn(12, refreshed)
+        self.assertEqual(refreshed[11].starts[0], 28800)
+        self.assertEqual(store[11].starts[0], 34088)
+
+        utils.get_store.invalidate()
+        reloaded = utils.get_store()
+        self.assertIsNotNone(reloaded.mapping)
+        self.assertEqual(reloaded.to_dict(), refreshed.to_dict())
+
+
+class PresenceAnalyzerAggregatesTestCase(unittest.TestCase):
+    """
+    Weekday aggregation engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def test_summarize_user(self):
+        """
+        Test summary of user entries by weekday.
+        """
+        summary = aggregates.WeekdaySummary.summarize_user(
+            utils.get_store()[11])
+        self.assertItemsEqual(summary.keys(), aggregates.WeekdaySummary.KEYS)
+        self.assertEqual(summary['count'][3], 2)
+        self.assertEqual(summary['total'][3], 45968)
+        self.assertEqual(summary['mean'][3], 22984.0)
+        self.assertEqual(summary['start'][0], 33134.0)
+        self.assertEqual(summary['end'][0], 57257.0)
+        self.assertEqual(summary['count'][5], 0)
+        self.assertEqual(summary['mean'][5], 0)
+
+    def test_summarize_user_match_grouping(self):
+        """
+        Test summaries match group_by_weekday helpers.
+        """
+        store = utils.get_store()
+        for user_id in store:
+            summary = aggregates.WeekdaySummary.summarize_user(store[user_id])
+            weekdays = group_by_weekday(store[user_id])
+            starts, ends = group_by_weekday_start_end(store[user_id])
+            for i in range(7):
+                self.assertEqual(summary['mean'][i], mean(weekdays[i]))
+                self.assertEqual(summary['total'][i], sum(weekdays[i]))
+                self.assertEqual(summary['start'][i], mean(starts[i]))
+                self.assertEqual(summary['end'][i], mean(ends[i]))
+
+    def test_user_presence_between(self):
+        """
+        Test bisected date range of user entries.
+        """
+        user = utils.get_store()[11]
+        first = datetime.date(2013, 9, 10).toordinal()
+        last = datetime.date(2013, 9, 12).toordinal()
+        self.assertIs(user.between(), user)
+        self.assertEqual(list(user.between(first, last).dates),
+                         range(first, last + 1))
+        self.assertEqual(len(user.between(last=first)), 3)
+        self.assertEqual(len(user.between(first=last + 10)), 0)
+
+    def test_get_user_summary(self):
+        """
+        Test weekday summary of user entries in date range.
+        """
+        self.assertIs(utils.get_user_summary(11), utils.get_summary().get(11))
+        self.assertIsNone(utils.get_user_summary(99, 1, 2))
+        first = datetime.date(2013, 9, 9).toordinal()
+        summary = utils.get_user_summary(11, first, first)
+        self.assertEqual(summary['total'], [24123, 0, 0, 0, 0, 0, 0])
+
+    def test_window_summaries(self):
+        """
+        Test precomputed summaries of common date windows.
+        """
+        store = utils.get_store()
+        windows = aggregates.WindowSummaries(store, datetime.date(2013, 9, 30))
+        month = windows.summaries['month']
+        self.assertEqual(windows.bounds['month'],
+                         (datetime.date(2013, 9, 1).toordinal(),
+                          datetime.date(2013, 9, 30).toordinal()))
+        self.assertIs(windows.find(*windows.bounds['month']), month)
+        self.assertIsNone(windows.find(1, 2))
+        self.assertEqual(month.users, store.summary.users)
+        self.assertEqual(windows.bounds['last_90_days'][0],
+                         datetime.date(2013, 7, 3).toordinal())
+
+        october = datetime.date(2013, 10, 1).toordinal()
+        windows.apply([(12, october, None, (0, 100))])
+        self.assertEqual(month.get(12)['total'], [0] * 7)
+
+    def test_occupancy_index(self):
+        """
+        Test occupancy buckets against presence counted second by second.
+        """
+        monday = datetime.date(2013, 9, 9).toordinal()
+        entries = [
+            (monday, 9 * 3600 + 100, 9 * 3600 + 200),
+            (monday, 8 * 3600 + 450, 17 * 3600 + 30),
+            (monday + 7, 0, 24 * 3600),
+            (monday + 1, 12 * 3600, 12 * 3600 + 900),
+            (monday + 2, 500, 400),
+        ]
+        index = aggregates.OccupancyIndex(entries)
+        self.assertEqual(index.days, [2, 1, 0, 0, 0, 0, 0])
+
+        def expected(day, entries):
+            seconds = [0] * aggregates.BUCKETS
+            for ordinal, start, end in entries:
+                if (ordinal - 1) % 7 == day:
+                    for second in range(start, end):
+                        seconds[second // aggregates.BUCKET_SECONDS] += 1
+            return [
+                float(value) / aggregates.BUCKET_SECONDS / index.days[day]
+                if index.days[day] else 0
+                for value in seconds
+            ]
+
+        for day in range(7):
+            self.assertEqual(index.occupancy[day], expected(day, entries))
+
+        changed = index.copy()
+        changed.apply([
+            (10, monday + 1, (12 * 3600, 12 * 3600 + 900),
+             (11 * 3600, 11 * 3600 + 1)),
+            (10, monday + 3, None, (3600, 7200)),
+        ])
+        self.assertEqual(index.occupancy[1], expected(1, entries))
+        self.assertEqual(changed.days, [2, 1, 0, 1, 0, 0, 0])
+        self.assertEqual(
+            changed.occupancy,
+            aggregates.OccupancyIndex(entries[:3] + [
+                (monday + 1, 11 * 3600, 11 * 3600 + 1),
+                (monday + 3, 3600, 7200),
+            ]).occupancy,
+        )
+
+    def test_weekday_summary(self):
+        """
+        Test weekday summary index built with the store.
+        """
+        summary = utils.get_summary()
+        self.assertIsInstance(summary, aggregates.WeekdaySummary)
+        self.assertIs(summary, utils.get_store().summary)
+        self.assertEqual(len(summary), 2)
+        self.assertIn(11, summary)
+        self.assertIsNone(summary.get(99))
+        user = summary.get(11)
+        self.assertEqual(user['total'][3], 45968)
+        self.assertEqual(user['mean'][3], 22984.0)
+        self.assertEqual(user['start'][0], 33134.0)
+        self.assertEqual(user['end'][0], 57257.0)
+        self.assertEqual(user['mean'][5], 0)
+        self.assertGreaterEqual(summary.build_time, 0)
+        self.assertGreater(summary.nbytes, 0)
+
+
+class PresenceAnalyzerDatabaseTestCase(unittest.TestCase):
+    """
+    SQLite storage tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'presence.sqlite')
+        database.import_entries(self.path,
+                                utils.CsvSource(TEST_DATA_CSV).read())
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_NAMES': TEST_USERS_NAMES,
+            'DATA_SQLITE': self.path,
+            'STORAGE': 'sqlite',
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'STORAGE': 'csv'})
+        shutil.rmtree(self.tmp_dir)
+
+    def test_import_entries(self):
+        """
+        Test import of entries, last entry of a day wins.
+        """
+        count = database.import_entries(self.path, [
+            (10, 735000, 100, 200),
+            (10, 735000, 300, 400),
+            (11, 735001, 100, 200),
+        ])
+        self.assertEqual(count, 2)
+        self.assertEqual(os.listdir(self.tmp_dir), ['presence.sqlite'])
+        presence = database.PresenceDatabase(self.path)
+        self.assertEqual(presence.user_ids, [10, 11])
+        monday = datetime.date(2013, 9, 9)
+        database.import_entries(self.path, [
+            (10, monday.toordinal(), 100, 200),
+            (10, monday.toordinal(), 300, 500),
+        ])
+        self.assertEqual(database.PresenceDatabase(self.path)
+                         .user_summary(10)['total'][0], 200)
+
+        self.assertRaises(sqlite3.Error, database.import_entries, self.path,
+                          [(12, monday.toordinal(), 100)])
+        self.assertEqual(os.listdir(self.tmp_dir), ['presence.sqlite'])
+        self.assertEqual(database.PresenceDatabase(self.path).user_ids, [10])
+
+    def test_user_summary(self):
+        """
+        Test summaries calculated by database against in-memory ones.
+        """
+        presence = utils.get_database()
+        store = utils.get_store()
+        self.assertEqual(presence.keys(), sorted(store.keys()))
+        self.assertIsNone(presence.user_summary(99))
+        first, last = store[11].dates[1], store[11].dates[3]
+        for user_id in store:
+            self.assertEqual(presence.user_summary(user_id),
+                             store.summary.get(user_id))
+            self.assertEqual(
+                presence.user_summary(user_id, first, last),
+                aggregates.WeekdaySummary.summarize_user(
+                    store[user_id].between(first, last)),
+            )
+            self.assertEqual(
+                presence.user_summary(user_id, first=first),
+                aggregates.WeekdaySummary.summarize_user(
+                    store[user_id].between(first)),
+            )
+
+    def test_views(self):
+        """
+        Test API responses served from database.
+        """
+        urls = [
+            '/api/v1/users',
+            '/api/v1/presence_weekday/11',
+            '/api/v1/presence_start_end/10',
+            '/api/v1/mean_time_weekday/11?from=2013-09-10',
+            '/api/v1/presence_weekday/99',
+            '/api/v1/weekday_stats?users=10,99',
+            '/api/v1/occupancy',
+        ]
+        responses = [self.client.get(url).data for url in urls]
+        main.app.config.update({'STORAGE': 'csv'})
+        self.assertEqual(responses,
+                         [self.client.get(url).data for url in urls])
+
+    def test_data_version(self):
+        """
+        Test reloading of database replaced by new import.
+        """
+        etag, _ = utils.data_version()
+        self.assertEqual(utils.get_user_ids(), [10, 11])
+        database.import_entries(self.path, [(12, 735000, 100, 200)])
+        os.utime(self.path, (0, 0))
+        self.assertEqual(utils.get_user_ids(), [12])
+        self.assertNotEqual(utils.data_version()[0], etag)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves documents of StandInServer, honouring conditional requests.
+    """
+
+    def do_GET(self):  # pylint: disable-msg=C0103
+        """
+        Responds with document at requested path.
+        """
+        self.server.requests.append(self.headers)
+        if self.path not in self.server.documents:
+            self.send_error(404)
+            return
+        body = self.server.documents[self.path]
+        content_type = 'image/png'
+        if self.path.endswith('.xml'):
+            content_type = 'text/xml'
+        etag = '"%x"' % (hash(body) & 0xffffffff)
+        last_modified = 'Mon, 16 Sep 2013 10:00:00 GMT'
+        if (self.headers.get('If-None-Match') == etag or
+                self.headers.get('If-Modified-Since') == last_modified and
+                'If-None-Match' not in self.headers):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server standing in for intranet, serving `documents`.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StandInHandler
+        )
+        self.documents = {}
+        self.requests = []
+
+    def url(self, path):
+        """
+        Returns URL of document at given path.
+        """
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class PresenceAnalyzerDownloadTestCase(unittest.TestCase):
+    """
+    Users export and avatars download tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.server = StandInServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'users.xml')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'USERS_NAMES': TEST_USERS_NAMES,
+                                'AVATARS_DIR': None})
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fetch(self):
+        """
+        Test streaming and conditional download.
+        """
+        with open(TEST_USERS_NAMES, 'rb') as users:
+            self.server.documents['/users.xml'] = users.read()
+        url = self.server.url('/users.xml')
+        self.assertTrue(download.fetch(url, self.path, chunk_size=64))
+        with open(self.path, 'rb') as users:
+            self.assertEqual(users.read(),
+                             self.server.documents['/users.xml'])
+        self.assertEqual(
+            download.read_validators(self.path)['last_modified'],
+            'Mon, 16 Sep 2013 10:00:00 GMT',
+        )
+
+        self.assertFalse(download.fetch(url, self.path))
+        self.assertEqual(self.server.requests[-1]['If-None-Match'],
+                         download.read_validators(self.path)['etag'])
+
+        self.server.documents['/users.xml'] = '<intranet />'
+        self.assertTrue(download.fetch(url, self.path))
+        with open(self.path, 'rb') as users:
+            self.assertEqual(users.read(), '<intranet />')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['users.xml', 'users.xml.validators'])
+
+    def test_fetch_error(self):
+        """
+        Test keeping of downloaded file when download fails.
+        """
+        with open(self.path, 'wb') as users:
+            users.write('<intranet />')
+        with self.assertRaises(urllib2.HTTPError):
+            download.fetch(self.server.url('/missing.xml'), self.path)
+        with open(self.path, 'rb') as users:
+            self.assertEqual(users.read(), '<intranet />')
+        self.assertEqual(os.listdir(self.tmp_dir), ['users.xml'])
+
+    def test_prefetch_avatars(self):
+        """
+        Test concurrent download of avatars.
+        """
+        for user_id in range(10, 20):
+            self.server.documents['/avatars/%d' % user_id] = 'png %d' % user_id
+        avatars = {
+            str(user_id): self.server.url('/avatars/%d' % user_id)
+            for user_id in range(10, 21)
+        }
+        directory = os.path.join(self.tmp_dir, 'avatars')
+        results = download.prefetch_avatars(avatars, directory, workers=3)
+        self.assertEqual(results, {str(i): True for i in range(10, 20)})
+        with open(download.avatar_path(directory, 15), 'rb') as avatar:
+            self.assertEqual(avatar.read(), 'png 15')
+
+        results = download.prefetch_avatars(avatars, directory, workers=3)
+        self.assertEqual(results, {str(i): False for i in range(10, 20)})
+
+        self.server.documents['/avatars/x'] = 'png x'
+        results = download.prefetch_avatars(
+            {'../x': self.server.url('/avatars/x')}, directory)
+        self.assertEqual(results, {})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'x')))
+        self.assertRaises(ValueError, download.avatar_path, directory,
+                          '../x')
+
+    def test_avatar_cache(self):
+        """
+        Test serving of avatars from local cache.
+        """
+        with open(TEST_USERS_NAMES, 'rb') as users:
+            self.server.documents['/users.xml'] = users.read().replace(
+                'intranet.stxnext.pl', '127.0.0.1:%d' %
+                self.server.server_address[1]
+            ).replace('https', 'http')
+        self.server.documents['/api/images/users/10'] = 'png 10'
+        download.fetch(self.server.url('/users.xml'), self.path)
+        main.app.config.update({
+            'USERS_NAMES': self.path,
+            'AVATARS_DIR': os.path.join(self.tmp_dir, 'avatars'),
+        })
+        client = main.app.test_client()
+
+        resp = client.get('/api/v1/get_avatar/10')
+        self.assertEqual(json.loads(resp.data),
+                         self.server.url('/api/images/users/10'))
+        avatars = utils.get_avatar_cache()
+        self.assertIsNone(avatars.refresh(10, 'http://example.com/'))
+        avatars.pool.close()
+        avatars.pool.join()
+        self.assertEqual(avatars.content_type(10), 'image/png')
+        self.assertFalse(avatars.is_stale(10))
+
+        resp = client.get('/api/v1/get_avatar/10')
+        url = json.loads(resp.data)
+        version = avatars.version(10)
+        self.assertEqual(url, '/api/v1/avatars/10/%s' % version)
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, 'png 10')
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertEqual(resp.headers['ETag'], '"%s"' % version)
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+        resp = client.get(url, headers={'If-None-Match': '"%s"' % version})
+        self.assertEqual(resp.status_code, 304)
+        resp = client.get('/api/v1/avatars/10/0123456789abcdef')
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(resp.location.endswith(url))
+        self.assertEqual(client.get('/api/v1/get_avatar/99').status_code,
+                         404)
+
 
 def suite():
     """
@@ -236,6 +1723,10 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAggregatesTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerDatabaseTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerDownloadTestCase))
     return suite
 
 
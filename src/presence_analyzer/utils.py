@@ -3,32 +3,1069 @@
 Helper functions used in views.
 """
 
+import os
 import csv
+import glob
+import time
+import zlib
+import threading
+import importlib
+import multiprocessing
+from itertools import chain, izip
+from collections import OrderedDict
 from json import dumps
-from functools import wraps
-from datetime import datetime
+from functools import wraps, partial
+from datetime import date, datetime
 
-from flask import Response
+from flask import Response, request
+from werkzeug.http import is_resource_modified
 
+from presence_analyzer import snapshot
 from presence_analyzer.main import app
-
-from xml.etree import ElementTree
+from presence_analyzer.store import PresenceStore, UserPresence
+from presence_analyzer.aggregates import WeekdaySummary, WindowSummaries, \
+    OccupancyIndex, window_bounds
+from presence_analyzer.database import PresenceDatabase
+from presence_analyzer.directory import UserDirectory
+from presence_analyzer.download import AvatarCache
+from presence_analyzer.metrics import timed
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
+class RawJSON(str):
+    """
+    Already encoded JSON, passed by jsonify as it is.
+    """
+
+
+class Payload(str):
+    """
+    Encoded JSON response, with its compressed variants by content encoding.
+
+    Key of response_cache entry holding the payload, if any, is kept as
+    `key` attribute.
+    """
+
+    def __new__(cls, value, key=None):
+        payload = super(Payload, cls).__new__(cls, value)
+        payload.key = key
+        payload.variants = {}
+        return payload
+
+
+def payload_size(payload):
+    """
+    Returns size of payload together with its compressed variants.
+    """
+    variants = getattr(payload, 'variants', {})
+    return len(payload) + sum(len(data) for data in variants.itervalues())
+
+
+COMPACT_SEPARATORS = (',', ':')
+
+# encoders by JSON_ENCODER config value, see get_json_encoder
+json_encoders = {}  # pylint: disable-msg=C0103
+
+
+def get_json_encoder():
+    """
+    Returns function encoding values as compact JSON.
+
+    JSON_ENCODER config is None for stdlib json, name of a module with
+    json compatible `dumps`, like 'simplejson' or 'ujson', or a function.
+    When the module is not available, stdlib json is used instead.
+    """
+    name = app.config['JSON_ENCODER']
+    if callable(name):
+        return name
+    encoder = json_encoders.get(name)
+    if encoder is None:
+        module_dumps = dumps
+        if name is not None:
+            try:
+                module_dumps = importlib.import_module(name).dumps
+            except ImportError:
+                log.warning('JSON encoder %s is not available, using json',
+                            name)
+        encoder = partial(module_dumps, separators=COMPACT_SEPARATORS)
+        try:
+            encoder([])
+        except TypeError:
+            # encoders without separators argument are compact already
+            encoder = module_dumps
+        json_encoders[name] = encoder
+    return encoder
+
+
+def json_dumps(value):
+    """
+    Encodes value as compact JSON with encoder given by JSON_ENCODER.
+    """
+    return get_json_encoder()(value)
+
+
+def data_version():
+    """
+    Returns ETag and last modification time of data files.
+
+    Both are derived from mtimes and sizes of data file (see data_path)
+    and USERS_NAMES the currently served data was loaded from, all API
+    responses stay the same until one of these files is reloaded or
+    the day changes. Last modification time is never earlier than
+    midnight of today, so If-Modified-Since alone does not revalidate
+    responses of date windows built on an earlier day.
+    """
+    loader = get_database if use_database() else get_store
+    loader()
+    get_directory()
+    keys = loader.cache.key + get_directory.cache.key
+    # date windows are relative to today, so is the version
+    today = date.today()
+    etag = '%08x' % (zlib.crc32(repr((keys, today))) & 0xffffffff)
+    last_modified = datetime.utcfromtimestamp(max(
+        [key[1] for key in keys] + [time.mktime(today.timetuple())]
+    ))
+    return etag, last_modified
+
+
+class ResponseCache(object):
+    """
+    LRU cache of encoded JSON responses, bounded by total size in bytes.
+
+    Entries belong to a data version, all of them are dropped as soon as
+    a different version is requested.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_ratio(self):
+        """
+        Returns fraction of lookups answered from cache.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0
+
+    def set_version(self, version):
+        """
+        Drops all entries when data version changes. Must hold the lock.
+        """
+        if version != self.version:
+            self.entries.clear()
+            self.nbytes = 0
+            self.version = version
+
+    def get(self, version, key):
+        """
+        Returns cached payload or None, marking it as recently used.
+        """
+        with self.lock:
+            self.set_version(version)
+            payload = self.entries.pop(key, None)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.entries[key] = payload
+            self.hits += 1
+            return payload
+
+    def put(self, version, key, payload, budget):
+        """
+        Stores payload, evicting least recently used ones above budget.
+
+        Size of payload includes its compressed variants, see Payload.
+        """
+        if payload_size(payload) > budget:
+            return
+        with self.lock:
+            self.set_version(version)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= payload_size(old)
+            self.entries[key] = payload
+            self.nbytes += payload_size(payload)
+            self.evict(budget)
+
+    def add_variant(self, payload, encoding, data, budget):
+        """
+        Keeps compressed variant of payload, counting it if it is cached.
+        """
+        with self.lock:
+            if encoding in payload.variants:
+                return
+            payload.variants[encoding] = data
+            if self.entries.get(payload.key) is payload:
+                self.nbytes += len(data)
+                self.evict(budget)
+
+    def evict(self, budget):
+        """
+        Drops least recently used entries above budget. Must hold the lock.
+        """
+        while self.nbytes > budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= payload_size(evicted)
+
+    def clear(self):
+        """
+        Drops all entries.
+        """
+        with self.lock:
+            self.set_version(None)
+
+
+response_cache = ResponseCache()  # pylint: disable-msg=C0103
+
+
+def cached_call(version, function, args, kwargs):
+    """
+    Returns Payload of view function, from response_cache if possible.
+    """
+    budget = app.config['RESPONSE_CACHE_BYTES']
+    if budget <= 0:
+        return Payload(encode(function(*args, **kwargs)))
+    key = (function.__name__, args, tuple(sorted(kwargs.items())),
+           tuple(sorted(request.args.iteritems(multi=True))))
+    result = response_cache.get(version, key)
+    if result is None:
+        result = Payload(encode(function(*args, **kwargs)), key)
+        response_cache.put(version, key, result, budget)
+    return result
+
+
+@timed('encode')
+def encode(result):
+    """
+    Encodes view result as JSON, unless it is RawJSON already.
+    """
+    if isinstance(result, RawJSON):
+        return result
+    return json_dumps(result)
+
+
+def accepted_encoding():
+    """
+    Returns content encoding preferred by client, 'gzip', 'deflate' or None.
+    """
+    gzip = request.accept_encodings['gzip']
+    deflate = request.accept_encodings['deflate']
+    if gzip <= 0 and deflate <= 0:
+        return None
+    return 'gzip' if gzip >= deflate else 'deflate'
+
+
+@timed('compress')
+def compress(data, encoding):
+    """
+    Compresses data with 'gzip' or 'deflate' content encoding.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'],
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return zlib.compress(data, app.config['COMPRESS_LEVEL'])
+
+
+def compressed(payload, encoding):
+    """
+    Returns (data, content encoding) of payload to send to client.
+
+    Payloads smaller than COMPRESS_MIN_SIZE are sent as they are, others
+    compressed with given encoding. Compressed variants are kept with
+    the payload, so cached payloads are compressed only once.
+    """
+    min_size = app.config['COMPRESS_MIN_SIZE']
+    if encoding is None or min_size is None or len(payload) < min_size:
+        return payload, None
+    data = payload.variants.get(encoding)
+    if data is None:
+        data = compress(payload, encoding)
+        response_cache.add_variant(payload, encoding, data,
+                                   app.config['RESPONSE_CACHE_BYTES'])
+    return data, encoding
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Responses carry ETag and Last-Modified headers of current data version,
+    conditional requests for unchanged data get empty 304 response without
+    calling the wrapped function. Cache-Control max-age is taken from
+    API_MAX_AGE config.
+
+    Encoded results are kept in response_cache, keyed by view, its
+    arguments and query string, up to RESPONSE_CACHE_BYTES in total.
+    Responses are compressed when client accepts it, see compressed().
     """
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        etag, last_modified = data_version()
+        if is_resource_modified(request.environ, etag,
+                                last_modified=last_modified):
+            payload = cached_call(etag, function, args, kwargs)
+            data, encoding = compressed(payload, accepted_encoding())
+            response = Response(data, mimetype='application/json')
+            if encoding is not None:
+                response.content_encoding = encoding
+        else:
+            response = Response(status=304)
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.max_age = app.config['API_MAX_AGE']
+        return response
     return inner
 
 
+def file_key(path):
+    """
+    Returns key identifying current version of file: path, mtime and size.
+    """
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size)
+
+
+class FileCache(object):
+    """
+    Process-wide, thread-safe cache of a value loaded from a file.
+
+    Value is reloaded only when file path, mtime or size changes. Lock is
+    held while loading, so concurrent requests wait for a single load
+    instead of parsing the same file in parallel.
+
+    Optional refresher is called with the stale value first; it may
+    return an updated value or None to request a full reload. It must
+    not modify the stale value, which may still be in use.
+
+    In background mode files are not checked on get(), the cached value
+    is returned as it is and refresh() is left to the Refresher thread.
+    Key and value are published together with a single reference swap.
+    """
+
+    def __init__(self, loader, refresher=None):
+        self.loader = loader
+        self.refresher = refresher
+        self.lock = threading.Lock()
+        self.entry = (None, None)
+        self.background = False
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @property
+    def hit_ratio(self):
+        """
+        Returns fraction of lookups answered without reloading value.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0
+
+    @property
+    def key(self):
+        """
+        Returns key of files the cached value was loaded from.
+        """
+        return self.entry[0]
+
+    @property
+    def value(self):
+        """
+        Returns cached value.
+        """
+        return self.entry[1]
+
+    def get(self, *paths):
+        """
+        Returns cached value, reloading it when any of files has changed.
+        """
+        key, value = self.entry
+        if (self.background and key is not None and
+                tuple(path for path, _, _ in key) == paths):
+            self.hits += 1
+            return value
+        return self.refresh(*paths)
+
+    def refresh(self, *paths):
+        """
+        Checks files and reloads cached value when any of them has changed.
+        """
+        key = tuple(file_key(path) for path in paths)
+        with self.lock:
+            if key == self.key:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.entry = (key, self.reload())
+            return self.value
+
+    def reload(self):
+        """
+        Refreshes stale value if possible, loads it from scratch otherwise.
+        """
+        if self.refresher is not None and self.value is not None:
+            value = self.refresher(self.value)
+            if value is not None:
+                self.refreshes += 1
+                return value
+        return self.loader()
+
+    def invalidate(self):
+        """
+        Drops cached value, next call will reload it.
+        """
+        with self.lock:
+            self.entry = (None, None)
+
+
+# functions decorated with cache(), in order of definition
+cached_functions = []  # pylint: disable-msg=C0103
+
+
+def config_paths(config_keys):
+    """
+    Returns paths of files given by config keys or functions returning them.
+
+    Keys and functions may give a single path or a list of them.
+    """
+    paths = []
+    for key in config_keys:
+        value = key() if callable(key) else app.config[key]
+        if isinstance(value, basestring):
+            paths.append(value)
+        else:
+            paths.extend(value)
+    return paths
+
+
+def cache(config_keys, refresher=None):
+    """
+    Caches result of wrapped function until file from app config changes.
+
+    Accepts single config key or a tuple of them, value is then reloaded
+    when any of the files changes. Functions returning path may be given
+    instead of keys, see config_paths. Cache object is available as
+    `cache` attribute of decorated function, `invalidate` attribute drops
+    cached value. See FileCache for meaning of refresher.
+    """
+    if isinstance(config_keys, basestring) or callable(config_keys):
+        config_keys = (config_keys,)
+
+    def decorator(function):
+        file_cache = FileCache(function, refresher)
+
+        @wraps(function)
+        def inner():
+            return file_cache.get(*config_paths(config_keys))
+        inner.cache = file_cache
+        inner.config_keys = config_keys
+        inner.invalidate = file_cache.invalidate
+        cached_functions.append(inner)
+        return inner
+    return decorator
+
+
+class Refresher(threading.Thread):
+    """
+    Background thread reloading cached data when data files change.
+
+    Once started, it switches all caches to background mode: requests
+    are served from the last published values and never wait for files
+    to be parsed.
+    """
+
+    def __init__(self, interval):
+        super(Refresher, self).__init__(name='presence-refresher')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """
+        Refreshes loaded caches, in order of definition of cached functions.
+
+        Caches never used in this process are left empty.
+        """
+        for function in cached_functions:
+            if function.cache.key is None:
+                continue
+            try:
+                function.cache.refresh(*config_paths(function.config_keys))
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Cannot refresh %s', function.__name__)
+
+    def start(self):
+        """
+        Loads presence data and users, then starts watching files.
+        """
+        data_version()
+        get_users_listing()
+        for function in cached_functions:
+            function.cache.background = True
+        super(Refresher, self).start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        """
+        Stops the thread and switches caches back to checking files.
+        """
+        self.stopped.set()
+        for function in cached_functions:
+            function.cache.background = False
+
+
+def start_refresher(interval):
+    """
+    Starts background Refresher checking data files every interval seconds.
+
+    Only one refresher runs in a process, running one is returned when
+    called again.
+    """
+    refresher = app.extensions.get('presence_refresher')
+    if refresher is None or not refresher.is_alive():
+        refresher = app.extensions['presence_refresher'] = Refresher(interval)
+        refresher.start()
+    return refresher
+
+
+def cache_stats():
+    """
+    Returns hits, misses and hit ratio of cached functions and responses.
+
+    Number of entries and their size in bytes are added for responses.
+    """
+    caches = [(function.__name__, function.cache)
+              for function in cached_functions]
+    caches.append(('responses', response_cache))
+    stats = {
+        name: {
+            'hits': counts.hits,
+            'misses': counts.misses,
+            'hit_ratio': counts.hit_ratio,
+        }
+        for name, counts in caches
+    }
+    with response_cache.lock:
+        stats['responses'].update({
+            'entries': len(response_cache),
+            'nbytes': response_cache.nbytes,
+        })
+    return stats
+
+
+def index_stats():
+    """
+    Returns stats of weekday summary indexes of loaded presence data,
+    see WeekdaySummary.stats(), the ones of date windows by name.
+
+    Data is not loaded for this, nothing is returned until it is, nor
+    with SQLite storage.
+    """
+    store = get_store.cache.value
+    if use_database() or store is None or store.summary is None:
+        return {}
+    stats = {'summary': store.summary.stats()}
+    if store.windows is not None:
+        stats['windows'] = {
+            name: summary.stats()
+            for name, summary in store.windows.summaries.iteritems()
+        }
+    return stats
+
+
+def parse_date(value):
+    """
+    Parses YYYY-MM-DD date into day ordinal.
+
+    Canonical dates are parsed by slicing, anything else is left to
+    datetime.strptime, which is much slower.
+    """
+    if (len(value) == 10 and value[4] == value[7] == '-' and
+            value[:4].isdigit() and value[5:7].isdigit() and
+            value[8:].isdigit()):
+        year, month, day = int(value[:4]), int(value[5:7]), int(value[8:])
+        return date(year, month, day).toordinal()
+    return datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+
+
+def parse_time(value):
+    """
+    Parses HH:MM:SS time into seconds since midnight.
+
+    Canonical times are parsed by slicing, anything else is left to
+    datetime.strptime, which is much slower.
+    """
+    if (len(value) == 8 and value[2] == value[5] == ':' and
+            value[:2].isdigit() and value[3:5].isdigit() and
+            value[6:].isdigit()):
+        hour, minute, second = int(value[:2]), int(value[3:5]), int(value[6:])
+        if hour < 24 and minute < 60 and second < 60:
+            return hour * 3600 + minute * 60 + second
+    return seconds_since_midnight(datetime.strptime(value, '%H:%M:%S').time())
+
+
+def parse_rows(rows):
+    """
+    Yields (user_id, date_ordinal, start, end) tuples from CSV rows.
+
+    Start and end are given in seconds since midnight, malformed lines
+    are logged and skipped.
+    """
+    for i, row in enumerate(rows):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            entry = (int(row[0]), parse_date(row[1]),
+                     parse_time(row[2]), parse_time(row[3]))
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+
+        yield entry
+
+
+class CsvSource(object):
+    """
+    Reading position in an append-only CSV file.
+
+    Remembers offset of the end of last complete line parsed so far and
+    CRC32 checksum of the file up to that offset, so later reads can
+    parse only appended lines. An unterminated last line is parsed but
+    not included in the offset, it is parsed again on next read. Size of
+    the file when it was last read, unterminated line included, is kept
+    as `size`, checksum of up to TAIL_SIZE bytes before the offset as
+    `tail`.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    TAIL_SIZE = 64 * 1024
+
+    def __init__(self, path, offset=0, checksum=0, size=None, tail=None):
+        self.path = path
+        self.offset = offset
+        self.checksum = checksum
+        self.size = offset if size is None else size
+        self.tail = tail
+
+    def lines(self, csvfile):
+        """
+        Yields lines from current offset, advancing offset, checksum and
+        size.
+        """
+        self.size = self.offset
+        for line in csvfile:
+            self.size += len(line)
+            if line.endswith('\n'):
+                self.offset += len(line)
+                self.checksum = zlib.crc32(line, self.checksum) & 0xffffffff
+            yield line
+
+    def read(self):
+        """
+        Yields entries from lines appended since last read.
+        """
+        with open(self.path, 'rb') as csvfile:
+            csvfile.seek(self.offset)
+            rows = csv.reader(self.lines(csvfile), delimiter=',')
+            for entry in parse_rows(rows):
+                yield entry
+            self.tail = self.tail_checksum(csvfile)
+
+    def tail_checksum(self, csvfile):
+        """
+        Returns CRC32 checksum of up to TAIL_SIZE bytes before offset.
+        """
+        start = max(self.offset - self.TAIL_SIZE, 0)
+        csvfile.seek(start)
+        return zlib.crc32(csvfile.read(self.offset - start)) & 0xffffffff
+
+    def is_appended(self):
+        """
+        Checks that already parsed part of the file was left unchanged.
+
+        Only the tail before the offset is compared, so the cost does not
+        grow with the file. Sources without known tail checksum, like the
+        ones loaded from snapshot, compare whole parsed part instead.
+        """
+        if os.path.getsize(self.path) < self.offset:
+            return False
+        with open(self.path, 'rb') as csvfile:
+            if self.tail is not None:
+                return self.tail_checksum(csvfile) == self.tail
+            checksum = 0
+            remaining = self.offset
+            while remaining > 0:
+                chunk = csvfile.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    return False
+                checksum = zlib.crc32(chunk, checksum)
+                remaining -= len(chunk)
+        return checksum & 0xffffffff == self.checksum
+
+
+def csv_paths():
+    """
+    Returns paths of CSV files given by DATA_CSV config.
+
+    DATA_CSV is a path or a glob pattern, or a list of them. Files are
+    returned in given order, files matching a pattern sorted by path.
+    When the same user and date occur in many files, row of the last
+    file wins, as if the files were concatenated.
+    """
+    patterns = app.config['DATA_CSV']
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern)))
+        else:
+            paths.append(pattern)
+    return paths
+
+
+@timed('refresh_csv')
+def refresh_store(store):
+    """
+    Folds lines appended to DATA_CSV files since last load into the store.
+
+    Returns new store with updated summaries and occupancy index, sharing
+    unchanged users with the stale one, which is left intact. Changed
+    users of a store mapped from shared snapshot are copied into private
+    arrays, the snapshot itself is rewritten on next full load. Returns None,
+    requesting a full reload, when a file was truncated or rewritten,
+    files were added or removed, or lines were appended to a file other
+    than the last one, as they might conflict with rows of later files.
+    """
+    if [source.path for source in store.sources] != csv_paths():
+        return None
+    sources = [CsvSource(source.path, source.offset, source.checksum,
+                         source.size, source.tail)
+               for source in store.sources]
+    for source in sources:
+        if not source.is_appended():
+            log.info('%s was rewritten, reloading it', source.path)
+            return None
+    for source in sources[:-1]:
+        if os.path.getsize(source.path) != source.size:
+            log.info('%s has grown, reloading all files', source.path)
+            return None
+    refreshed, changes = store.extended(sources[-1].read())
+    refreshed.sources = sources
+    # users left unchanged may still use columns of shared snapshot
+    refreshed.mapping = store.mapping
+    refreshed.summary = store.summary.copy()
+    refreshed.summary.apply(changes)
+    if store.windows is not None:
+        refreshed.windows = store.windows.copy()
+        refreshed.windows.apply(changes)
+    refreshed.occupancy = store.occupancy.copy()
+    refreshed.occupancy.apply(changes)
+    log.info('Folded %d appended entries into presence data', len(changes))
+    return refreshed
+
+
+def load_snapshot(path):
+    """
+    Loads store from binary snapshot of given CSV file, if enabled and valid.
+    """
+    loaded = snapshot.load(snapshot.snapshot_path(path), path,
+                           shared=app.config['DATA_SNAPSHOT_SHARED'])
+    if loaded is None:
+        return None
+    store, offset, checksum = loaded
+    store.sources = [CsvSource(path, offset, checksum)]
+    log.info('Presence data loaded from snapshot of %s', path)
+    return store
+
+
+def save_snapshot(store, stat):
+    """
+    Writes binary snapshot of store parsed from CSV file.
+
+    Returns True when snapshot was written.
+    """
+    source = store.sources[0]
+    try:
+        return snapshot.save(snapshot.snapshot_path(source.path), store,
+                             source.path, stat, source.offset,
+                             source.checksum)
+    except EnvironmentError:
+        log.warning('Cannot write snapshot of %s', source.path,
+                    exc_info=True)
+        return False
+
+
+def parse_file(path):
+    """
+    Parses CSV file into PresenceStore.
+    """
+    source = CsvSource(path)
+    store = PresenceStore.from_entries(source.read())
+    store.sources = [source]
+    return store
+
+
+def parse_dumped(path):
+    """
+    Parses CSV file in worker process, see parse_store().
+
+    Returns (source, dumped store) tuple.
+    """
+    store = parse_file(path)
+    return store.sources[0], store.dump()
+
+
+def parse_store(paths):
+    """
+    Parses CSV files into single PresenceStore, see csv_paths().
+
+    With DATA_CSV_WORKERS other than 1, many files are parsed in parallel
+    by a pool of that many processes (0 is one per CPU) and merged
+    afterwards. The pool is forked from a request or refresher thread,
+    while other threads may hold locks, like the ones of logging
+    handlers, so it is opt-in.
+    """
+    workers = app.config['DATA_CSV_WORKERS'] or multiprocessing.cpu_count()
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        stores = [parse_file(path) for path in paths]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            parsed = pool.map(parse_dumped, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        stores = []
+        for source, dumped in parsed:
+            store = PresenceStore.load(dumped)
+            store.sources = [source]
+            stores.append(store)
+
+    if len(stores) == 1:
+        return stores[0]
+    store = PresenceStore.merged(stores)
+    store.sources = [part.sources[0] for part in stores]
+    return store
+
+
+def read_entries(paths):
+    """
+    Yields entries of CSV files one after another, see csv_paths().
+    """
+    return chain.from_iterable(CsvSource(path).read() for path in paths)
+
+
+def load_store(path):
+    """
+    Loads PresenceStore from binary snapshot or CSV file.
+
+    Snapshot lock lets only one process parse the CSV file and publish
+    its snapshot, other processes wait and load the published one. With
+    DATA_SNAPSHOT_SHARED enabled, snapshot columns are mapped without
+    copying, so all processes share a single copy of presence data.
+    When the lock cannot be taken, e.g. in a read-only directory, the
+    CSV file is parsed without snapshot.
+    """
+    store = load_snapshot(path)
+    if store is not None:
+        return store
+    try:
+        with snapshot.exclusive(snapshot.snapshot_path(path)):
+            store = load_snapshot(path)
+            if store is None:
+                stat = os.stat(path)
+                store = parse_store([path])
+                if (save_snapshot(store, stat) and
+                        app.config['DATA_SNAPSHOT_SHARED']):
+                    store = load_snapshot(path) or store
+    except EnvironmentError:
+        if store is not None:
+            return store
+        log.warning('Cannot lock snapshot of %s, parsing it without snapshot',
+                    path, exc_info=True)
+        store = parse_store([path])
+    return store
+
+
+@cache(csv_paths, refresher=refresh_store)
+@timed('load_csv')
+def get_store():
+    """
+    Extracts presence data from CSV files into compact PresenceStore.
+
+    Weekday summary and occupancy indexes are built together with the
+    store. When the files only grow, later calls parse just the appended
+    lines.
+
+    With DATA_SNAPSHOT config enabled and a single CSV file, store is
+    loaded from a valid binary snapshot when possible, otherwise the
+    snapshot is rewritten after parsing the file, see load_store().
+    """
+    paths = csv_paths()
+    if app.config['DATA_SNAPSHOT'] and len(paths) == 1:
+        store = load_store(paths[0])
+    else:
+        store = parse_store(paths)
+    store.summary = WeekdaySummary(store)
+    store.windows = WindowSummaries(store)
+    store.occupancy = OccupancyIndex.from_store(store)
+    log.info(
+        'Weekday summary of %d users built in %.3fs, %d bytes',
+        len(store.summary), store.summary.build_time, store.summary.nbytes,
+    )
+    return store
+
+
+def use_database():
+    """
+    Tells whether presence data is read from SQLite database.
+
+    Storage backend is selected by STORAGE config: 'csv' parses DATA_CSV
+    into memory, 'sqlite' queries DATA_SQLITE database.
+    """
+    return app.config['STORAGE'] == 'sqlite'
+
+
+def data_path():
+    """
+    Returns path of database or paths of CSV files data is read from.
+    """
+    if use_database():
+        return app.config['DATA_SQLITE']
+    return csv_paths()
+
+
+@cache('DATA_SQLITE')
+def get_database():
+    """
+    Opens SQLite database of presence data, see PresenceDatabase.
+    """
+    return PresenceDatabase(app.config['DATA_SQLITE'])
+
+
+def get_user_ids():
+    """
+    Returns sorted ids of users present in data.
+    """
+    if use_database():
+        return get_database().user_ids
+    return sorted(get_summary().users)
+
+
+def get_window_bounds():
+    """
+    Returns (first, last) day ordinals of common windows by name.
+    """
+    return window_bounds(date.today())
+
+
+def get_summary():
+    """
+    Returns weekday summary index of current presence data.
+    """
+    return get_store().summary
+
+
+def get_occupancy():
+    """
+    Returns occupancy index of current presence data, see OccupancyIndex.
+
+    The index is built once per data reload.
+    """
+    if use_database():
+        return get_database().occupancy()
+    return get_store().occupancy
+
+
+def get_windows(store=None):
+    """
+    Returns summaries of common date windows, rebuilt when the day changes.
+
+    Windows of current store are returned, unless other one is given.
+    """
+    if store is None:
+        store = get_store()
+    windows = store.windows
+    if windows is None or windows.today != date.today():
+        windows = store.windows = WindowSummaries(store)
+    return windows
+
+
+def current_data():
+    """
+    Returns presence data currently served, PresenceDatabase with SQLite
+    storage, PresenceStore otherwise.
+
+    Streamed responses pass it to get_user_summary and get_user_entries,
+    so all users are read from the same data even when it is reloaded
+    in the meantime.
+    """
+    if use_database():
+        return get_database()
+    return get_store()
+
+
+@timed('summarize')
+def get_user_summary(user_id, first=None, last=None, data=None):
+    """
+    Returns weekday summary of user entries from first to last day ordinal.
+
+    Whole history and common windows are served from precomputed indexes,
+    other ranges are summarized from a bisected slice of user entries.
+    With SQLite storage, summaries are calculated by database instead.
+    Data is read from current_data() unless given. Returns None for
+    unknown users.
+    """
+    if data is None:
+        data = current_data()
+    if isinstance(data, PresenceDatabase):
+        return data.user_summary(user_id, first, last)
+    if first is None and last is None:
+        return data.summary.get(user_id)
+    window = get_windows(data).find(first, last)
+    if window is not None:
+        return window.get(user_id)
+    if user_id not in data:
+        return None
+    return WeekdaySummary.summarize_user(data[user_id].between(first, last))
+
+
+def get_user_entries(user_id, first=None, last=None, data=None):
+    """
+    Returns (ordinal, start, end) entries of user from first to last day.
+
+    Entries are sorted by date and produced lazily, unknown users have
+    none. Data is read from current_data() unless given.
+    """
+    if data is None:
+        data = current_data()
+    if isinstance(data, PresenceDatabase):
+        return data.entries(user_id, first, last)
+    if user_id not in data:
+        return iter(())
+    user = data[user_id].between(first, last)
+    return izip(user.dates, user.starts, user.ends)
+
+
+@timed('get_data')
+@cache(csv_paths)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -46,85 +1083,114 @@ def get_data():
             },
         }
     }
+
+    It is a compatibility view of get_store(), prefer the latter in new code.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    return get_store().to_dict()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+@cache('USERS_NAMES')
+@timed('parse_xml')
+def get_directory():
+    """
+    Parses users XML file into UserDirectory.
+    """
+    return UserDirectory.parse(app.config['USERS_NAMES'])
 
-    return data
 
+avatar_cache_lock = threading.Lock()  # pylint: disable-msg=C0103
 
+
+def get_avatar_cache():
+    """
+    Returns AvatarCache of AVATARS_DIR, None when it is not configured.
+    """
+    directory = app.config['AVATARS_DIR']
+    if not directory:
+        return None
+    with avatar_cache_lock:
+        avatars = app.extensions.get('presence_avatars')
+        if avatars is None or avatars.directory != directory:
+            avatars = app.extensions['presence_avatars'] = AvatarCache(
+                directory, app.config['AVATAR_MAX_AGE'],
+                app.config['DOWNLOAD_WORKERS'],
+            )
+        return avatars
+
+
+@timed('get_users')
 def get_users():
     """
-    Getting users from xml
+    Returns names of users, indexed by user_id.
     """
-    users = {}
-    user_id = []
-    xml = open(app.config['USERS_NAMES'], 'r')
-    xmldoc = ElementTree.parse(xml)
-    root = xmldoc.getroot()
-    users_xml = root.findall('users')[0]
-    user_id = [i.attrib['id'] for i in users_xml.findall('user')]
-    names = [i.text for i in users_xml.findall('user/name')]
-    users = dict(zip(user_id, names))
-    return users
+    return get_directory().names
 
 
+@timed('get_avatars')
 def get_avatars():
     """
-    Getting avatars
+    Returns avatar URLs of users, indexed by user_id.
+    """
+    return get_directory().avatars
+
+
+@cache((data_path, 'USERS_NAMES'))
+def get_users_listing():
+    """
+    Returns encoded JSON listing of users present in data, sorted by name.
     """
-    avatars = {}
-    user_id = []
-    xml = open(app.config['USERS_NAMES'], 'r')
-    xmldoc = ElementTree.parse(xml)
-    root = xmldoc.getroot()
-    users_xml = root.findall('users')[0]
-    user_id = [i.attrib['id'] for i in users_xml.findall('user')]
-    protocol = [i.text for i in root.findall('server/protocol')]
-    av_host = [i.text for i in root.findall('server/host')]
-    avatar = [i.text for i in users_xml.findall('user/avatar')]
-    adres = [(x+"://"+y+z) for x in protocol for y in av_host for z in avatar]
-    avatars = dict(zip(user_id, adres))
-    return avatars
+    directory = get_directory()
+    present = set(str(user_id) for user_id in get_user_ids())
+    return RawJSON(json_dumps([
+        {'user_id': user_id, 'name': directory.names[user_id]}
+        for user_id in directory.ordered if user_id in present
+    ]))
 
 
+def weekday_entries(items):
+    """
+    Yields (weekday, start, end) tuples from presence entries of one user.
+
+    Accepts both UserPresence and {date: {'start': .., 'end': ..}} dict,
+    times are returned in seconds since midnight.
+    """
+    if isinstance(items, UserPresence):
+        return items.weekday_entries()
+    return (
+        (date.weekday(),
+         seconds_since_midnight(items[date]['start']),
+         seconds_since_midnight(items[date]['end']))
+        for date in items
+    )
+
+
+@timed('group_by_weekday')
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
     result = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for weekday, start, end in weekday_entries(items):
+        result[weekday].append(interval(start, end))
     return result
 
 
 def seconds_since_midnight(time):
     """
     Calculates amount of seconds since midnight.
+
+    Values already given in seconds are returned unchanged.
     """
+    if isinstance(time, (int, long)):
+        return time
     return time.hour * 3600 + time.minute * 60 + time.second
 
 
 def interval(start, end):
     """
     Calculates inverval in seconds between two datetime.time objects.
+
+    Seconds since midnight, as kept by PresenceStore, are accepted too.
     """
     return seconds_since_midnight(end) - seconds_since_midnight(start)
 
@@ -132,19 +1198,20 @@ def interval(start, end):
 def mean(items):
     """
     Calculates arithmetic mean. Returns zero for empty lists.
+
+    Works with any sized iterable, e.g. arrays from PresenceStore.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+@timed('group_by_weekday_start_end')
 def group_by_weekday_start_end(items):
     """
     Groups start and end hours by weekday
     """
     result_start = {i: [] for i in range(7)}
     result_stop = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result_start[date.weekday()].append(seconds_since_midnight(start))
-        result_stop[date.weekday()].append(seconds_since_midnight(end))
+    for weekday, start, end in weekday_entries(items):
+        result_start[weekday].append(start)
+        result_stop[weekday].append(end)
     return (result_start, result_stop)
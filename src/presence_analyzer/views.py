@@ -2,14 +2,22 @@
 """
 Defines views.
 """
+import zlib
 import calendar
 import locale
-from flask import render_template
+from collections import OrderedDict
+from flask import Response, abort, redirect, render_template, request, \
+    url_for
 
 from presence_analyzer.main import app
-from presence_analyzer.utils import jsonify, get_data, mean, group_by_weekday
-from presence_analyzer.utils import group_by_weekday_start_end
-from presence_analyzer.utils import get_users, get_avatars
+from presence_analyzer.aggregates import BUCKETS, BUCKET_SECONDS
+from presence_analyzer.utils import jsonify, get_user_ids, get_user_summary
+from presence_analyzer.utils import get_window_bounds, parse_date
+from presence_analyzer.utils import get_occupancy, current_data
+from presence_analyzer.utils import get_directory, get_users_listing, \
+    get_avatar_cache, cache_stats, index_stats, json_dumps
+from presence_analyzer.metrics import metrics
+from presence_analyzer import export
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
@@ -41,49 +49,166 @@ def start_end():
     return render_template('presence_start_end.html')
 
 
+@app.route('/occupancy')
+def occupancy():
+    """
+    Redirects to occupancy page.
+    """
+    return render_template('occupancy.html')
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    users = get_users()
-    data = get_data()
-    result = [{'user_id': i, 'name': users[i]}
-              for i in users.keys() if int(i) in data.keys()]
-    #import pdb; pdb.set_trace()
-    result.sort(key=lambda item: item['name'], cmp=locale.strcoll)
-    return result
+    return get_users_listing()
+
+
+# avatar URLs contain content hash, so images never change
+AVATAR_IMAGE_MAX_AGE = 365 * 24 * 3600
 
 
 @app.route('/api/v1/get_avatar/<int:user_id>', methods=['GET'])
-@jsonify
 def avatar_view(user_id):
     """
-    Viewing avatars
+    Returns avatar URL of given user.
+
+    With AVATARS_DIR configured, URL of local copy is returned once the
+    image is downloaded. Missing and stale images are refreshed in
+    background, intranet URL is returned until the first download ends.
     """
-    avatars = get_avatars()
-    user_id = str(user_id)
-    return avatars[user_id]
+    url = get_directory().avatars.get(str(user_id))
+    if url is None:
+        abort(404)
+    avatars = get_avatar_cache()
+    if avatars is not None:
+        version = avatars.version(user_id)
+        if version is None or avatars.is_stale(user_id):
+            avatars.refresh(user_id, url)
+        if version is not None:
+            url = url_for('avatar_image', user_id=user_id, version=version)
 
+    payload = json_dumps(url)
+    response = Response(payload, mimetype='application/json')
+    response.set_etag('%08x' % (zlib.crc32(payload) & 0xffffffff))
+    response.cache_control.max_age = app.config['API_MAX_AGE']
+    return response.make_conditional(request)
 
-@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
-def mean_time_weekday_view(user_id):
+
+@app.route('/api/v1/avatars/<int:user_id>/<version>', methods=['GET'])
+def avatar_image(user_id, version):
     """
-    Returns mean presence time of given user grouped by weekday.
+    Serves local copy of avatar image, version being its content hash.
+
+    Requests for other versions are redirected to the current one.
+    """
+    avatars = get_avatar_cache()
+    if avatars is None:
+        abort(404)
+    if version in request.if_none_match:
+        response = Response(status=304)
+    else:
+        image = avatars.read(user_id)
+        if image is None:
+            abort(404)
+        data, current = image
+        if version != current:
+            return redirect(
+                url_for('avatar_image', user_id=user_id, version=current)
+            )
+        response = Response(data, mimetype=avatars.content_type(user_id))
+    response.set_etag(version)
+    response.cache_control.public = True
+    response.cache_control.max_age = AVATAR_IMAGE_MAX_AGE
+    return response
+
+
+def mean_time_weekday(summary):
+    """
+    Builds mean presence time by weekday from user summary.
+    """
+    return [(calendar.day_abbr[weekday], value)
+            for weekday, value in enumerate(summary['mean'])]
+
+
+def presence_weekday(summary):
+    """
+    Builds total presence time by weekday from user summary.
+    """
+    result = [(calendar.day_abbr[weekday], value)
+              for weekday, value in enumerate(summary['total'])]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(summary):
     """
-    #import pdb; pdb.set_trace()
-    data = get_data()
-    if user_id not in data:
+    Builds mean start and end hours by weekday from user summary.
+    """
+    result = []
+    for i in range(7):
+        result.append((
+            calendar.day_abbr[i], summary['start'][i], summary['end'][i]))
+
+    return result
+
+
+METRICS = OrderedDict([
+    ('mean_time_weekday', mean_time_weekday),
+    ('presence_weekday', presence_weekday),
+    ('presence_start_end', presence_start_end),
+])
+
+
+def parse_date_range():
+    """
+    Reads date range of weekday metrics from query string.
+
+    Range is given either by `from` and `to` dates (YYYY-MM-DD, both
+    inclusive and optional) or by `window` name, 'month' or
+    'last_90_days'. Returns (first, last) day ordinals, None for open
+    bounds. Aborts with 400 on invalid values.
+    """
+    window = request.args.get('window')
+    if window:
+        bounds = get_window_bounds().get(window)
+        if bounds is None:
+            abort(400)
+        return bounds
+
+    try:
+        return tuple(
+            parse_date(request.args[name]) if request.args.get(name) else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        abort(400)
+
+
+def user_metric(metric, user_id):
+    """
+    Returns given metric of one user, empty list for unknown users.
+
+    See parse_date_range for date range query parameters.
+    """
+    summary = get_user_summary(user_id, *parse_date_range())
+    if summary is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
+    return METRICS[metric](summary)
 
-    return result
+
+@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@jsonify
+def mean_time_weekday_view(user_id):
+    """
+    Returns mean presence time of given user grouped by weekday.
+    """
+    return user_metric('mean_time_weekday', user_id)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -92,17 +217,7 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return []
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return user_metric('presence_weekday', user_id)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -111,15 +226,167 @@ def presence_start_end_view(user_id):
     """
     Returns mean start and end hours grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return []
+    return user_metric('presence_start_end', user_id)
 
-    result_start, result_stop = group_by_weekday_start_end(data[user_id])
-    result = []
-    for i in range(7):
-        result.append((
-            calendar.day_abbr[i], mean(result_start[i]), mean(result_stop[i])))
 
+def parse_users():
+    """
+    Reads ids of requested users from query string.
+
+    `users` is a comma separated list of ids or 'all' (default), unknown
+    ids are left out. Aborts with 400 on invalid values.
+    """
+    users = request.args.get('users', 'all')
+    if users == 'all':
+        return get_user_ids()
+    try:
+        user_ids = [int(i) for i in users.split(',')]
+    except ValueError:
+        abort(400)
+    present = set(get_user_ids())
+    return [i for i in user_ids if i in present]
+
+
+def parse_batch_args():
+    """
+    Reads user ids and metric names of batch request from query string.
+
+    See parse_users for `users`, `metrics` is a comma separated list of
+    METRICS names, all of them by default. Aborts with 400 on invalid
+    values.
+    """
+    user_ids = parse_users()
+    metrics = request.args.get('metrics')
+    metrics = metrics.split(',') if metrics else METRICS.keys()
+    if any(metric not in METRICS for metric in metrics):
+        abort(400)
+    return user_ids, metrics, parse_date_range()
+
+
+def batch_results(user_ids, metrics, date_range, data=None):
+    """
+    Yields (user_id, {metric: result}) pairs of batch request.
+
+    Data is read from current_data() unless given.
+    """
+    for user_id in user_ids:
+        user = get_user_summary(user_id, *date_range, data=data)
+        yield user_id, {metric: METRICS[metric](user) for metric in metrics}
+
+
+@app.route('/api/v1/weekday_stats', methods=['GET'])
+def weekday_stats_view():
+    """
+    Returns weekday metrics of many users, indexed by user_id.
+
+    See parse_batch_args and parse_date_range for query parameters.
+    With `stream=1` the response is sent user by user instead of being
+    built in memory, all users from data loaded when the request came.
+    """
+    if request.args.get('stream'):
+        batch = batch_results(*parse_batch_args(), data=current_data())
+
+        def generate():
+            yield '{'
+            for i, (user_id, result) in enumerate(batch):
+                separator = ',' if i else ''
+                yield '%s"%d":%s' % (separator, user_id, json_dumps(result))
+            yield '}'
+        return Response(generate(), mimetype='application/json')
+    return weekday_stats_batch()
+
+
+@jsonify
+def weekday_stats_batch():
+    """
+    Returns weekday metrics of many users as a single JSON document.
+    """
+    return dict(batch_results(*parse_batch_args()))
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Returns mean number of people present by weekday and 15 minute bucket.
+
+    First row holds bucket start times, following ones weekday names and
+    occupancy of each bucket, see OccupancyIndex.
+    """
+    index = get_occupancy()
+    result = [['Weekday'] + [
+        '%02d:%02d' % divmod(bucket * BUCKET_SECONDS // 60, 60)
+        for bucket in range(BUCKETS)
+    ]]
+    for day, row in enumerate(index.occupancy):
+        result.append(
+            [calendar.day_abbr[day]] + [round(value, 2) for value in row]
+        )
     return result
+
+
+def export_response(name, fields, records):
+    """
+    Streams records in format given by `format` parameter, 'ndjson'
+    (default) or 'csv'.
+
+    Records are encoded one by one and sent in chunks, compressed with
+    gzip when client accepts it. Aborts with 400 on unknown format.
+    """
+    name_format = request.args.get('format', 'ndjson')
+    if name_format not in export.FORMATS:
+        abort(400)
+    mimetype, encoder = export.FORMATS[name_format]
+    chunks = export.buffered(encoder(fields, records))
+    gzip = request.accept_encodings['gzip'] > 0
+    if gzip:
+        chunks = export.gzipped(chunks)
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=%s.%s' % (name, name_format)
+    )
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/api/v1/export/entries', methods=['GET'])
+def export_entries_view():
+    """
+    Exports presence entries of users, see export.ENTRY_FIELDS.
+
+    See parse_users and parse_date_range for query parameters, and
+    export_response for output format.
+    """
+    records = export.entry_records(parse_users(), *parse_date_range(),
+                                   data=current_data())
+    return export_response('entries', export.ENTRY_FIELDS, records)
+
+
+@app.route('/api/v1/export/weekday_stats', methods=['GET'])
+def export_weekday_stats_view():
+    """
+    Exports weekday aggregates of users, see export.SUMMARY_FIELDS.
+
+    See parse_users and parse_date_range for query parameters, and
+    export_response for output format.
+    """
+    records = export.summary_records(parse_users(), *parse_date_range(),
+                                     data=current_data())
+    return export_response('weekday_stats', export.SUMMARY_FIELDS, records)
+
+
+@app.route('/api/v1/_metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns latency histograms of endpoints and timed steps of this
+    process, together with hit rates of its caches and build costs of
+    weekday summary indexes.
+    """
+    result = metrics.to_dict()
+    result['caches'] = cache_stats()
+    result['indexes'] = index_stats()
+    response = Response(json_dumps(result), mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response